@@ -29,6 +29,7 @@ setuptools.setup(
         'matplotlib',
         'seaborn>=0.10',
         'scikit-learn',
+        'threadpoolctl',
         'psutil',
         'pymc3==3.6',
     ],
@@ -4,50 +4,56 @@ import pandas as pd
 import argparse
 import os
 from .utensils import log_timer
-from .vecs import Vectors
+from .vecs import Vectors, dataset_vocab, _scores_fname
+from .neighbors import sharded_top, _block_size, _scatter_exclude
 import logging
 logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
 path = os.path.dirname(__file__)
 
 
 @log_timer
-def solve_analogies(vectors, analogies, novel=False, method='multiplicative', whole_matrix=False):
+def solve_analogies(vectors, analogies, novel=False, method='multiplicative', whole_matrix=False, max_memory=1e9, jobs=1, top_k=1, n_candidates=None):
     """Solves analogies using specified methods.
 
+    Analogies are solved in batches, sized so that each batch's score matrices fit in `max_memory` bytes.
+    Datasets reuse the same operands (a1, a2, b1) many times, so for each batch the similarities of all word vectors to each distinct operand word
+    are computed once, in a single matrix multiplication, and shared by all analogies in the batch that use that word.
+    Likewise, the a1/a2 term of the score is computed once for each distinct a1/a2 pair.
+    The words in each analogy are then excluded by row index, and the `top_k` best scoring words are selected for each analogy.
+    When scoring existing analogies with `top_k` > 1, accuracy@5 and accuracy@10 are reported as well (if `top_k` is at least 5 or 10).
+    Analogy words are looked up in all word vectors, but with `n_candidates` only the most frequent words are searched for answers,
+    so a large lookup vocabulary keeps the missing word penalty down without making the search slower.
+    For vectors restricted to a vocabulary (see `Vectors()`), load them with `keep_top` of at least `n_candidates`, so all candidates are loaded.
+
     :param vectors: Vectors object containing word vectors
     :param analogies: pandas DataFrame of analogies, columns labeled a1, a2, b1(, b2)
     :param novel: whether the task is to solve novel analogies (or alternatively, score the predictions relative to existing analogies)
     :param method: solving method to use (options are `additive` and `multiplicative`, multiplicative is the default and usually performs best)
-    :param whole_matrix: boolean determining whether to use whole matrix multiplication (faster, but uses more RAM than you may have available, `False` is the default)
+    :param whole_matrix: boolean determining whether to solve all analogies in a single batch (faster, but uses more RAM than you may have available, `False` is the default)
+    :param max_memory: maximum size of the score matrices for a batch of analogies in bytes, if not using `whole_matrix` (default is 1e9)
+    :param jobs: number of vocabulary shards to search in parallel (default is 1)
+    :param top_k: number of candidates to return for each analogy, with their scores (default is 1)
+    :param n_candidates: number of most frequent words to search for answers (default is None, which searches all word vectors)
     :return: dict containing score and predictions in separate pandas DataFrames
     """
-    missing = 0
+    if method not in ['multiplicative', 'additive']:
+        raise ValueError(f'unknown analogy solving method {method}')
     total = len(analogies)
-    vecs_dict = vectors.as_dict()
-
-    # make numpy arrays of vecs for given words in analogies
-    a1 = []
-    a2 = []
-    b1 = []
-    b2_words = []
-    analogies_words = []
-
-    for idx, analogy in analogies.iterrows():
-        if all(word in vecs_dict.keys() for word in analogy.values):
-            a1.append(vecs_dict[analogy['a1']])
-            a2.append(vecs_dict[analogy['a2']])
-            b1.append(vecs_dict[analogy['b1']])
-            if not novel:
-                b2_words.append(analogy['b2'])
-            analogies_words.append([analogy['a1'], analogy['a2'], analogy['b1']])
-        else:
-            missing += 1
-    a1 = np.vstack(a1)
-    a2 = np.vstack(a2)
-    b1 = np.vstack(b1)
+
+    # look up rows for all words in analogies, skipping analogies that contain missing words
+    idx = {}
+    found = np.ones(total, dtype=bool)
+    for column in analogies.columns:
+        idx[column], missing_words = vectors.indices(analogies[column])
+        found &= ~missing_words
+    missing = total - found.sum()
+
+    a1_idx = idx['a1'][found]
+    a2_idx = idx['a2'][found]
+    b1_idx = idx['b1'][found]
     if not novel:
-        b2_words = np.vstack(b2_words)
-    analogies_words = np.vstack(analogies_words)
+        b2_words = analogies['b2'].values[found]
+    analogies_words = analogies[['a1', 'a2', 'b1']].values[found]
     l = len(analogies_words)
 
     # cosine distance (assumes vectors are normalized to unit length)
@@ -58,50 +64,59 @@ def solve_analogies(vectors, analogies, novel=False, method='multiplicative', wh
     def cos_pos(a, b):
         return (1.0 + np.matmul(a, b.T)) / 2.0
 
-    # compute cosine similarity between all word vecs and
-    # the vecs predicted from the word word analogy arrays
-    if method == 'multiplicative':
-        # multiplicative method from Levy & Goldberg (2014)
-        eps = np.finfo(np.float64).eps
-        if whole_matrix:
-            logging.info('computing analogies using whole matrix multiplicative method')
-            b2_pred = ((cos_pos(vectors.vectors, b1) * cos_pos(vectors.vectors, a2)) / (cos_pos(vectors.vectors, a1) + eps))
+    # candidates are the rows of the most frequent words, which come first
+    n_rows = vectors.n if n_candidates is None else int(np.searchsorted(vectors.ranks, n_candidates))
+    if n_rows < min(vectors.n if n_candidates is None else n_candidates, vectors.vocab_size):
+        logging.warning(f'only {n_rows} out of the {int(n_candidates)} most frequent words are loaded as candidates')
+
+    # compute cosine similarity between candidate word vecs and
+    # the vecs predicted from the word word analogy arrays, one batch of analogies at a time
+    logging.info(f'computing analogies using batched {method} method, searching {n_rows} candidates')
+    eps = float(np.finfo(np.float64).eps)
+    if whole_matrix:
+        max_memory = np.inf
+    # the similarities to the operands, the pair terms, two gathered columns for each analogy, and the combined scores are held in memory at the same time
+    block = _block_size(n_rows, l, 6 * np.dtype(vectors.compute_dtype).itemsize, max_memory)
+    top_k = min(top_k, n_rows)
+    b2_pred_idx = np.zeros((l, top_k), dtype=np.int64)
+    b2_pred_scores = np.zeros((l, top_k), dtype=vectors.compute_dtype)
+    for start in range(0, l, block):
+        stop = min(start + block, l)
+        excluded = [a1_idx[start:stop], a2_idx[start:stop], b1_idx[start:stop]]
+        # similarities are computed once for each distinct operand word, columns are then looked up per analogy
+        operands, operand_cols = np.unique(np.concatenate(excluded), return_inverse=True)
+        a1_cols, a2_cols, b1_cols = operand_cols.reshape(3, -1)
+        pairs, pair_cols = np.unique(np.stack([a1_cols, a2_cols], axis=1), axis=0, return_inverse=True)
+        pair_cols = pair_cols.ravel()
+        operand_vecs = vectors.rows(operands)
+
+        def score(rows, first_row):
+            if method == 'multiplicative':
+                # multiplicative method from Levy & Goldberg (2014)
+                sims = cos_pos(rows, operand_vecs)
+                ratios = sims[:, pairs[:, 1]] / (sims[:, pairs[:, 0]] + eps)
+                b2_pred = sims[:, b1_cols] * ratios[:, pair_cols]
+            else:
+                # additive method from Mikolov et al. (2013)
+                # consider this method deprecated in favor of the multiplicative method
+                # (dot products are linear, so cos(x, b1 - a1 + a2) = cos(x, b1) - cos(x, a1) + cos(x, a2))
+                sims = cos(rows, operand_vecs)
+                offsets = sims[:, pairs[:, 1]] - sims[:, pairs[:, 0]]
+                b2_pred = sims[:, b1_cols] + offsets[:, pair_cols]
             # zero out other words in analogy (yes, this feels like cheating)
-            for i in range(l):
-                b2_pred[np.isin(vectors.words, analogies_words[i]), i] = -1.0
-            b2_pred_idx = np.argmax(b2_pred, axis=0)
-        else:
-            logging.info('computing analogies using linewise multiplicative method')
-            b2_pred_idx = np.zeros(l, dtype=np.int32)
-            for i in range(l):
-                b2_pred = ((cos_pos(vectors.vectors, b1[i].reshape(1, -1)) * cos_pos(vectors.vectors, a2[i].reshape(1, -1)))
-                           / (cos_pos(vectors.vectors, a1[i].reshape(1, -1)) + eps)).squeeze()
-                # zero out other words in analogy (yes, this feels like cheating)
-                b2_pred[np.isin(vectors.words, analogies_words[i])] = -1.0
-                b2_pred_idx[i] = np.argmax(b2_pred)
-
-    elif method == 'additive':
-        # additive method from Mikolov et al. (2013)
-        # consider this method deprecated in favor of the multiplicative method
-        if whole_matrix:
-            logging.info('computing analogies using whole matrix additive method')
-            b2_pred = cos(vectors.vectors, b1 - a1 + a2)
-            # zero out other words in analogy (yes, this feels like cheating)
-            for i in range(l):
-                b2_pred[np.isin(vectors.words, analogies_words[i])] = -1.0
-            b2_pred_idx = np.argmax(b2_pred, axis=0)
-        else:
-            logging.info('computing analogies using linewise additive method')
-            b2_pred_idx = np.zeros(l, dtype=np.int32)
-            for i in range(l):
-                b2_pred = cos(vectors.vectors, (b1[i] - a1[i] + a2[i]).reshape(1, -1)).squeeze()
-                # zero out other words in analogy (yes, this feels like cheating)
-                b2_pred[np.isin(vectors.words, analogies_words[i])] = -1.0
-                b2_pred_idx[i] = np.argmax(b2_pred)
+            for words_idx in excluded:
+                _scatter_exclude(b2_pred, words_idx, first_row)
+            return b2_pred
+
+        b2_pred_idx[start:stop], b2_pred_scores[start:stop] = sharded_top(vectors, score, top_k, jobs, n_rows=n_rows)
 
     # return pandas df with b2 and b2 predicted
     analogies = pd.DataFrame(analogies_words, columns=['a1', 'a2', 'b1'])
-    analogies['b2 predicted'] = vectors.words[b2_pred_idx]
+    analogies['b2 predicted'] = vectors.words[b2_pred_idx[:, 0]]
+    if top_k > 1:
+        for i in range(top_k):
+            analogies[f'candidate {i + 1}'] = vectors.words[b2_pred_idx[:, i]]
+            analogies[f'score {i + 1}'] = b2_pred_scores[:, i]
     if not novel:
         analogies['b2'] = b2_words
         analogies['accuracy'] = (analogies['b2'] == analogies['b2 predicted'])
@@ -109,21 +124,34 @@ def solve_analogies(vectors, analogies, novel=False, method='multiplicative', wh
         penalty = (total - missing) / total
         adjusted_score = score * penalty
         score = pd.DataFrame({'score': [score], 'adjusted score': [adjusted_score]})
+        for k in [5, 10]:
+            if top_k >= k:
+                accuracy = np.mean(np.any(vectors.words[b2_pred_idx[:, :k]] == np.asarray(b2_words, dtype=object).reshape(-1, 1), axis=1)) if l > 0 else np.nan
+                score[f'accuracy@{k}'] = accuracy
+                score[f'adjusted accuracy@{k}'] = accuracy * penalty
+        score['lookup vocabulary'] = vectors.vocab_size
+        score['candidate vocabulary'] = n_rows
     else:
         score = np.nan
     return {'score': score, 'predictions': analogies}
 
 
 @log_timer
-def evaluate_analogies(lang, vecs_fname, method='multiplicative', whole_matrix=False):
+def evaluate_analogies(lang, vecs_fname, method='multiplicative', whole_matrix=False, jobs=1, top_k=10, n=1e6, n_candidates=2e5):
     """Solve all available analogies for a set of word vectors in a given language.
 
+    Analogy words are looked up among the `n` most frequent words, answers are searched for among the `n_candidates` most frequent words.
+    Only the vectors for those candidates and for words in the analogy datasets are loaded.
     Writes scores to tab-separated text file but also returns them.
 
     :param vecs_fname: filename of a file containing a set of word vectors
     :param lang: language to evaluate word vectors in (uses two-letter ISO codes)
     :param method: solving method to use (options are `additive` and `multiplicative`, multiplicative is the default and usually performs best)
     :param whole_matrix: boolean determining whether to use whole matrix multiplication (faster, but uses more RAM than you may have available, `False` is the default)
+    :param jobs: number of vocabulary shards to search in parallel (default is 1)
+    :param top_k: number of candidates to consider for accuracy@k, scores include accuracy@5 and accuracy@10 if `top_k` is at least 5 or 10 (default is 10)
+    :param n: number of most frequent words to look up analogy words in (default is 1e6)
+    :param n_candidates: number of most frequent words to search for answers (default is 2e5)
     :return: pandas DataFrame containing the analogies results
     """
     analogies_path = os.path.join(path, 'datasets', 'analogies')
@@ -133,24 +161,25 @@ def evaluate_analogies(lang, vecs_fname, method='multiplicative', whole_matrix=F
     if not os.path.exists(results_path):
         os.mkdir(results_path)
     logging.info(f'evaluating analogy solving with {vecs_fname}')
-    vectors = Vectors(vecs_fname, normalize=True, n=2e5, d=300)
+    vectors = Vectors(vecs_fname, normalize=True, n=n, vocab=dataset_vocab(lang, ['analogies']), keep_top=n_candidates)
     scores = []
     for analogies_fname in os.listdir(analogies_path):
         if analogies_fname.startswith(lang):
             if analogies_fname.startswith(lang) and analogies_fname.endswith('.tsv'):
                 logging.info(f'solving analogies from {analogies_fname}')
                 analogies = pd.read_csv(os.path.join(analogies_path, analogies_fname), sep='\t', comment='#')
-                score = solve_analogies(vectors, analogies, method=method, whole_matrix=whole_matrix)['score']
+                score = solve_analogies(vectors, analogies, method=method, whole_matrix=whole_matrix, jobs=jobs, top_k=top_k,
+                                        n_candidates=n_candidates)['score']
                 score['source'] = analogies_fname
                 scores.append(score)
-    scores_fname = os.path.split(vecs_fname)[1].replace('.vec', '.tsv')
+    scores_fname = _scores_fname(vecs_fname)
     if len(scores) > 0:
         scores = pd.concat(scores)
         scores.to_csv(os.path.join(results_path, scores_fname), sep='\t', index=False)
         return scores
 
 
-def novel_analogies(vecs_fname, analogies_fname, method='multiplicative', whole_matrix=False):
+def novel_analogies(vecs_fname, analogies_fname, method='multiplicative', whole_matrix=False, jobs=1, top_k=1, n=1e6, n_candidates=None):
     """Solve novel analogies, using word vectors.
 
     Writes predictions to tab-separated text file.
@@ -159,11 +188,20 @@ def novel_analogies(vecs_fname, analogies_fname, method='multiplicative', whole_
     :param analogies_fname: file containing analogies in tab-separated columns named 'a1', 'a2', and 'b1'
     :param method: solving method to use (options are `additive` and `multiplicative`, multiplicative is the default and usually performs best)
     :param whole_matrix: boolean determining whether to use whole matrix multiplication (faster, but uses more RAM than you may have available, `False` is the default)
+    :param jobs: number of vocabulary shards to search in parallel (default is 1)
+    :param top_k: number of candidates to write for each analogy, with their scores (default is 1)
+    :param n: number of most frequent words to look up analogy words in (default is 1e6)
+    :param n_candidates: number of most frequent words to search for answers (default is None, which searches all `n` words)
     """
     logging.info(f'solving novel analogies with {vecs_fname}')
-    vectors = Vectors(vecs_fname, normalize=True, n=1e6, d=300)
     analogies = pd.read_csv(analogies_fname, sep='\t', comment='#')
-    results = solve_analogies(vectors, analogies, novel=True, method=method, whole_matrix=whole_matrix)
+    if n_candidates is None:
+        vectors = Vectors(vecs_fname, normalize=True, n=n)
+    else:
+        vocab = set(analogies[['a1', 'a2', 'b1']].astype(str).values.ravel())
+        vectors = Vectors(vecs_fname, normalize=True, n=n, vocab=vocab, keep_top=n_candidates)
+    results = solve_analogies(vectors, analogies, novel=True, method=method, whole_matrix=whole_matrix, jobs=jobs, top_k=top_k,
+                              n_candidates=n_candidates)
     base_fname = '.'.join(analogies_fname.split('.')[:-1])
     results['predictions'].to_csv(f'{base_fname}.predictions.tsv', sep='\t', index=False)
 
@@ -173,11 +211,20 @@ if __name__ == '__main__':
     argparser.add_argument('lang', help='language to solve analogies in (uses two-letter ISO language codes)')
     argparser.add_argument('vecs_fname', help='word vectors to evaluate')
     argparser.add_argument('--whole_matrix', action='store_true',
-                           help='perform computations using whole matrices instead of column-wise (potentially results in big memory footprint)')
+                           help='solve all analogies in a single batch instead of in memory-bounded batches (potentially results in big memory footprint)')
+    argparser.add_argument('--jobs', default=1, type=int, help='number of vocabulary shards to search in parallel')
+    argparser.add_argument('--top_k', type=int,
+                           help='number of candidates to write for novel analogies, or to score accuracy@k with (default is 1 for novel analogies and 10 otherwise)')
+    argparser.add_argument('--n', default=1e6, type=float, help='number of most frequent words to look up analogy words in')
+    argparser.add_argument('--n_candidates', type=float,
+                           help='number of most frequent words to search for answers (default is 2e5 for evaluation and all words for novel analogies)')
     argparser.add_argument('--novel_analogies', help='file containing novel analogies to solve, in tab-separated columns named a1, a2, and b1')
     args = argparser.parse_args()
 
     if args.novel_analogies:
-        novel_analogies(vecs_fname=args.vecs_fname, analogies_fname=args.novel_analogies, whole_matrix=args.whole_matrix)
+        novel_analogies(vecs_fname=args.vecs_fname, analogies_fname=args.novel_analogies, whole_matrix=args.whole_matrix, jobs=args.jobs,
+                        top_k=1 if args.top_k is None else args.top_k, n=args.n, n_candidates=args.n_candidates)
     else:
-        print(evaluate_analogies(lang=args.lang, vecs_fname=args.vecs_fname, whole_matrix=args.whole_matrix))
+        print(evaluate_analogies(lang=args.lang, vecs_fname=args.vecs_fname, whole_matrix=args.whole_matrix, jobs=args.jobs,
+                                 top_k=10 if args.top_k is None else args.top_k, n=args.n,
+                                 n_candidates=2e5 if args.n_candidates is None else args.n_candidates))
@@ -0,0 +1,186 @@
+"""Approximate nearest neighbor search for word vectors, using an inverted file (IVF) index."""
+import numpy as np
+import argparse
+import os
+from .utensils import log_timer
+from .vecs import Vectors
+from .lookup import _file_stamp
+import logging
+logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
+
+
+def index_prefix(vecs_fname):
+    """Gets the filename prefix for the IVF index belonging to a set of word vectors.
+
+    :param vecs_fname: file containing word vectors
+    :return: filename prefix, the index is stored in files starting with this prefix, next to the word vectors
+    """
+    return '.'.join(vecs_fname.split('.')[:-1]) + '.ivf'
+
+
+def _assign(vectors, centroids, block_rows=65536):
+    # assign each row to the centroid with the highest cosine similarity
+    return np.concatenate([np.argmax(np.matmul(vectors.rows(slice(start, start + block_rows)), centroids.T), axis=1)
+                           for start in range(0, vectors.n, block_rows)])
+
+
+class IVFIndex:
+    """Creates an inverted file index over word vectors, for approximate nearest neighbor search.
+
+    Word vectors are clustered into lists using spherical k-means.
+    A search only scores the words in the `n_probe` lists whose centroids are closest to the target,
+    so increasing `n_probe` increases recall at the cost of speed.
+    Use `IVFIndex.build()` to build a new index and `IVFIndex.load()` to open a saved index (memory-mapped).
+
+    :param centroids: numpy array containing the unit length centroid of each list in rows
+    :param rows: numpy array containing the row indices of the word vectors, ordered by list
+    :param offsets: numpy array containing the start of each list in `rows` (plus the end of the last list)
+    :param stamp: size and modification time of the word vectors file the index was built for (default is None, if unknown)
+    """
+    def __init__(self, centroids, rows, offsets, stamp=None):
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+        self.stamp = stamp
+        self.n_lists = len(centroids)
+        self.n = len(rows)  # every indexed word vector is in exactly one list
+
+    @classmethod
+    @log_timer
+    def build(cls, vectors, n_lists=None, n_iter=10, sample_size=None, seed=0):
+        """Builds an IVF index for a set of word vectors.
+
+        :param vectors: Vectors object containing word vectors (should be normalized to unit length)
+        :param n_lists: number of lists to cluster the word vectors into (default is None, which uses 4 times the square root of the number of vectors),
+        at most the number of sampled vectors
+        :param n_iter: number of k-means iterations (default is 10)
+        :param sample_size: number of word vectors to fit the k-means centroids on (default is None, which uses 64 per list)
+        :param seed: random seed for sampling word vectors (default is 0)
+        :return: IVFIndex
+        """
+        rng = np.random.RandomState(seed)
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(vectors.n))
+        if sample_size is None:
+            sample_size = 64 * n_lists
+        sample = vectors.rows(np.sort(rng.choice(vectors.n, min(sample_size, vectors.n), replace=False)))
+        if n_lists > len(sample):
+            logging.warning(f'reducing n_lists from {n_lists} to {len(sample)}, the number of sampled vectors')
+            n_lists = len(sample)
+        logging.info(f'clustering {len(sample)} vectors into {n_lists} lists')
+
+        # spherical k-means: assign to the most similar centroid, then set centroids to the normalized mean of their members
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for i in range(n_iter):
+            assignments = np.argmax(np.matmul(sample, centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            norms = np.linalg.norm(sums, axis=1)
+            empty = norms == 0
+            # reseed empty lists with random sample vectors
+            sums[empty] = sample[rng.choice(len(sample), empty.sum(), replace=False)]
+            norms[empty] = 1.0
+            centroids = sums / norms.reshape(-1, 1)
+
+        assignments = _assign(vectors, centroids)
+        rows = np.argsort(assignments, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return cls(centroids, rows, offsets)
+
+    def save(self, prefix):
+        """Saves the index to .npy files, so it can be memory-mapped when loaded.
+
+        The number of indexed word vectors and the stamp of the word vectors file (if known) are saved in a .params file.
+
+        :param prefix: filename prefix to save the index under (see `index_prefix()`)
+        """
+        np.save(f'{prefix}.centroids.npy', self.centroids)
+        np.save(f'{prefix}.rows.npy', self.rows)
+        np.save(f'{prefix}.offsets.npy', self.offsets)
+        with open(f'{prefix}.params', 'w') as paramsfile:
+            paramsfile.write(f'{self.n}\n')
+            paramsfile.write(self.stamp if self.stamp is not None else '')
+
+    @classmethod
+    def load(cls, prefix):
+        """Loads a saved index, memory-mapping the arrays.
+
+        :param prefix: filename prefix the index was saved under (see `index_prefix()`)
+        :return: IVFIndex
+        """
+        stamp = None
+        if os.path.exists(f'{prefix}.params'):
+            with open(f'{prefix}.params', 'r') as paramsfile:
+                next(paramsfile)
+                stamp = paramsfile.readline() or None
+        return cls(np.load(f'{prefix}.centroids.npy', mmap_mode='r'),
+                   np.load(f'{prefix}.rows.npy', mmap_mode='r'),
+                   np.load(f'{prefix}.offsets.npy', mmap_mode='r'),
+                   stamp)
+
+    def search(self, vectors, target_vecs, num_neighbors=10, n_probe=8, exclude=None):
+        """Finds approximate nearest neighbors (by cosine similarity) of a set of target vectors.
+
+        :param vectors: Vectors object the index was built for
+        :param target_vecs: numpy array containing target vectors in rows
+        :param num_neighbors: number of neighbors to find for each target (default is 10)
+        :param n_probe: number of lists to search for each target (default is 8)
+        :param exclude: numpy array containing a row index to exclude for each target, e.g. the target word itself (-1 excludes nothing)
+        :return: tuple of numpy arrays containing row indices and similarities of the neighbors, with targets in rows, sorted by similarity
+        (rows for which fewer neighbors were found are padded with index -1 and similarity -inf)
+        """
+        if vectors.n != self.n:
+            raise ValueError(f'index was built for {self.n} word vectors, but {vectors.n} word vectors were passed')
+        target_vecs = np.asarray(target_vecs, dtype=vectors.compute_dtype)
+        n_probe = min(n_probe, self.n_lists)
+        probes = np.argpartition(-np.matmul(target_vecs, np.asarray(self.centroids).T), n_probe - 1, axis=1)[:, :n_probe]
+        neighbors = np.full((len(target_vecs), num_neighbors), -1, dtype=np.int64)
+        similarities = np.full((len(target_vecs), num_neighbors), -np.inf, dtype=vectors.compute_dtype)
+        for i, target in enumerate(target_vecs):
+            candidates = np.sort(np.concatenate([self.rows[self.offsets[j]:self.offsets[j + 1]] for j in probes[i]]))
+            if exclude is not None:
+                candidates = candidates[candidates != exclude[i]]
+            sims = np.matmul(vectors.rows(candidates), target)
+            k = min(num_neighbors, len(candidates))
+            if k > 0:
+                top = np.argpartition(-sims, k - 1)[:k]
+                top = top[np.argsort(-sims[top])]
+                neighbors[i, :k] = candidates[top]
+                similarities[i, :k] = sims[top]
+        return neighbors, similarities
+
+
+def load_index(vecs_fname, vectors):
+    """Loads the IVF index for a set of word vectors, building and saving it first if it does not exist or is out of date.
+
+    A saved index is out of date if it was built for a different number of word vectors,
+    or if the size or modification time of the word vectors file has changed since.
+
+    :param vecs_fname: file containing word vectors
+    :param vectors: Vectors object containing the word vectors from `vecs_fname` (should be normalized to unit length)
+    :return: IVFIndex
+    """
+    prefix = index_prefix(vecs_fname)
+    if os.path.exists(f'{prefix}.centroids.npy'):
+        index = IVFIndex.load(prefix)
+        if index.n == vectors.n and index.stamp == _file_stamp(vecs_fname):
+            return index
+        logging.info(f'{prefix} was built for different word vectors')
+    index = IVFIndex.build(vectors)
+    index.stamp = _file_stamp(vecs_fname)
+    index.save(prefix)
+    return index
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='build an approximate nearest neighbor (IVF) index for a set of word vectors')
+    argparser.add_argument('vecs_fname', help='word vectors to build the index for')
+    argparser.add_argument('--n', default=1e6, type=float, help='number of word vectors to index')
+    argparser.add_argument('--n_lists', type=int, help='number of lists (default is 4 times the square root of the number of vectors)')
+    argparser.add_argument('--n_iter', default=10, type=int, help='number of k-means iterations')
+    args = argparser.parse_args()
+
+    vectors = Vectors(args.vecs_fname, normalize=True, n=args.n)
+    index = IVFIndex.build(vectors, n_lists=args.n_lists, n_iter=args.n_iter)
+    index.stamp = _file_stamp(args.vecs_fname)
+    index.save(index_prefix(args.vecs_fname))
@@ -0,0 +1,212 @@
+"""Benchmark the speed, memory use, and accuracy trade-offs of different ways of storing and searching word vectors."""
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import time
+from .vecs import Vectors
+from .analogies import solve_analogies
+from .similarities import compare_similarities
+from .neighbors import top_neighbors
+from .ann import load_index
+from .reduce import reduce_vecs, reduced_fname, _pca_is_current
+from .utensils import log_timer
+import logging
+logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
+path = os.path.dirname(__file__)
+
+
+def _results_fname(kind, vecs_fname):
+    if not os.path.exists('results'):
+        os.mkdir('results')
+    results_path = os.path.join('results', 'benchmarks')
+    if not os.path.exists(results_path):
+        os.mkdir(results_path)
+    base_fname = '.'.join(os.path.split(vecs_fname)[1].split('.')[:-1])
+    return os.path.join(results_path, f'{kind}.{base_fname}.tsv')
+
+
+def _score_datasets(lang, vectors):
+    # score a Vectors object on all analogy and similarity datasets available in a language
+    scores = []
+    for task in ['analogies', 'similarities']:
+        datasets_path = os.path.join(path, 'datasets', task)
+        for fname in sorted(os.listdir(datasets_path)):
+            if fname.startswith(lang) and fname.endswith('.tsv'):
+                dataset = pd.read_csv(os.path.join(datasets_path, fname), sep='\t', comment='#')
+                t0 = time.time()
+                if task == 'analogies':
+                    score = solve_analogies(vectors, dataset)['score']['score'][0]
+                else:
+                    score = compare_similarities(vectors, dataset)['scores']['rank r'][0]
+                scores.append({'task': task, 'source': fname, 'score': score, 'seconds': time.time() - t0})
+    return scores
+
+
+@log_timer
+def compare_precisions(lang, vecs_fname, precisions=('float64', 'float32', 'float16', 'int8'), n=2e5):
+    """Compare analogy and similarity scores for word vectors stored at different precisions.
+
+    Loads the word vectors once for each precision and evaluates them on all analogy and similarity datasets available in a given language.
+    Score differences are computed relative to the first precision in the list.
+    Writes results to tab-separated text file but also returns them.
+
+    :param lang: language to evaluate word vectors in (uses two-letter ISO codes)
+    :param vecs_fname: word vectors to evaluate
+    :param precisions: storage precisions to compare (default is float64, float32, float16, and int8)
+    :param n: number of word vectors to load (default is 2e5)
+    :return: pandas DataFrame containing scores, score differences, memory use, and timings for each precision
+    """
+    results = []
+    for precision in precisions:
+        logging.info(f'evaluating {vecs_fname} stored as {precision}')
+        vectors = Vectors(vecs_fname, normalize=True, n=n, precision=precision)
+        megabytes = (vectors.vectors.nbytes + (0 if vectors.scales is None else vectors.scales.nbytes)) / 2 ** 20
+        for score in _score_datasets(lang, vectors):
+            score.update({'precision': precision, 'MB': megabytes})
+            results.append(score)
+    results = pd.DataFrame(results)
+    reference = results.loc[results['precision'] == precisions[0]].set_index(['task', 'source'])['score']
+    results['score difference'] = results['score'] - reference.loc[list(zip(results['task'], results['source']))].values
+    results = results[['precision', 'task', 'source', 'score', 'score difference', 'MB', 'seconds']]
+    results.to_csv(_results_fname('precisions', vecs_fname), sep='\t', index=False)
+    return results
+
+
+@log_timer
+def compare_dimensions(lang, vecs_fname, dims=(50, 100, 150), n=2e5):
+    """Compare analogy and similarity scores for word vectors reduced to different numbers of dimensions.
+
+    Reduces the word vectors using principal component analysis (see `subs2vec.reduce.reduce_vecs()`), unless the reduced binary stores already exist,
+    and evaluates the full and reduced vectors on all analogy and similarity datasets available in a given language.
+    The reduced stores have `n` in their filenames (see `subs2vec.reduce.reduced_fname()`),
+    so they are never mixed up with stores written by `subs2vec.reduce` from a different number of vectors.
+    If the vectors file has changed since the stores were written, all of them are reduced again.
+    Score differences are computed relative to the full vectors.
+    Writes results to tab-separated text file but also returns them.
+
+    :param lang: language to evaluate word vectors in (uses two-letter ISO codes)
+    :param vecs_fname: word vectors to evaluate
+    :param dims: numbers of dimensions to compare (default is 50, 100, and 150)
+    :param n: number of word vectors to load (default is 2e5)
+    :return: pandas DataFrame containing scores, score differences, memory use, and timings for each number of dimensions
+    """
+    current = _pca_is_current(vecs_fname, n)
+    if not current:
+        logging.info(f'no reduced stores for the current version of {vecs_fname}')
+    missing_dims = [d for d in dims if not (current and os.path.exists(reduced_fname(vecs_fname, d, n)))]
+    if len(missing_dims) > 0:
+        reduce_vecs(vecs_fname, missing_dims, n=n, name_n=True)
+    results = []
+    for d, fname in [(None, vecs_fname)] + [(d, reduced_fname(vecs_fname, d, n)) for d in dims]:
+        logging.info(f'evaluating {fname}')
+        vectors = Vectors(fname, normalize=True, n=n)
+        for score in _score_datasets(lang, vectors):
+            score.update({'d': vectors.d, 'MB': vectors.vectors.nbytes / 2 ** 20})
+            results.append(score)
+    results = pd.DataFrame(results)
+    reference = results.loc[results['d'] == results['d'][0]].set_index(['task', 'source'])['score']
+    results['score difference'] = results['score'] - reference.loc[list(zip(results['task'], results['source']))].values
+    results = results[['d', 'task', 'source', 'score', 'score difference', 'MB', 'seconds']]
+    results.to_csv(_results_fname('dimensions', vecs_fname), sep='\t', index=False)
+    return results
+
+
+@log_timer
+def ann_recall(vecs_fname, n_probes=(1, 2, 4, 8, 16, 32), num_neighbors=10, n_queries=1000, n=1e6, seed=0):
+    """Compare approximate nearest neighbors from an IVF index to exact nearest neighbors.
+
+    Uses the saved index for the word vectors if there is one and it was built for the same vectors, otherwise builds and saves it.
+    Query words are sampled at random from the vocabulary, and each query word is excluded from its own neighbors.
+    Writes results to tab-separated text file but also returns them.
+
+    :param vecs_fname: word vectors to benchmark
+    :param n_probes: numbers of index lists to search per query (default is 1, 2, 4, 8, 16, and 32)
+    :param num_neighbors: number of neighbors to retrieve, recall is computed at this k (default is 10)
+    :param n_queries: number of query words (default is 1000)
+    :param n: number of word vectors to load (default is 1e6)
+    :param seed: random seed for sampling query words (default is 0)
+    :return: pandas DataFrame containing recall@k and queries per second for exact search and each number of probes
+    """
+    vectors = Vectors(vecs_fname, normalize=True, n=n)
+    index = load_index(vecs_fname, vectors)
+    queries = np.random.RandomState(seed).choice(vectors.n, min(n_queries, vectors.n), replace=False)
+    query_vecs = vectors.rows(queries)
+
+    t0 = time.time()
+    exact, _ = top_neighbors(vectors, query_vecs, num_neighbors, exclude=queries)
+    results = [{'method': 'exact', 'n_probe': np.nan, 'recall': 1.0, 'queries per second': len(queries) / (time.time() - t0)}]
+    for n_probe in n_probes:
+        t0 = time.time()
+        approximate, _ = index.search(vectors, query_vecs, num_neighbors, n_probe=n_probe, exclude=queries)
+        seconds = time.time() - t0
+        recall = np.mean([len(np.intersect1d(a, b)) / exact.shape[1] for a, b in zip(approximate, exact)])
+        results.append({'method': 'ivf', 'n_probe': n_probe, 'recall': recall, 'queries per second': len(queries) / seconds})
+    results = pd.DataFrame(results)
+    results['n_lists'] = index.n_lists
+    results = results.rename(columns={'recall': f'recall@{num_neighbors}'})
+    results.to_csv(_results_fname('ann_recall', vecs_fname), sep='\t', index=False)
+    return results
+
+
+@log_timer
+def shard_scaling(vecs_fname, jobs=None, num_neighbors=10, n_queries=1000, n=1e6, seed=0):
+    """Measure how exact nearest neighbor search scales with the number of vocabulary shards searched in parallel.
+
+    Query words are sampled at random from the vocabulary, and each query word is excluded from its own neighbors.
+    Results for each number of shards are checked against the results for the first.
+    Writes results to tab-separated text file but also returns them.
+
+    :param vecs_fname: word vectors to benchmark
+    :param jobs: numbers of shards to compare (default is None, which uses powers of 2 up to the number of cores)
+    :param num_neighbors: number of neighbors to retrieve (default is 10)
+    :param n_queries: number of query words (default is 1000)
+    :param n: number of word vectors to load (default is 1e6)
+    :param seed: random seed for sampling query words (default is 0)
+    :return: pandas DataFrame containing queries per second and speedup relative to the first number of shards
+    """
+    if jobs is None:
+        jobs = [2 ** i for i in range(int(np.log2(os.cpu_count())) + 1)]
+    vectors = Vectors(vecs_fname, normalize=True, n=n)
+    queries = np.random.RandomState(seed).choice(vectors.n, min(n_queries, vectors.n), replace=False)
+    query_vecs = vectors.rows(queries)
+
+    results = []
+    for n_jobs in jobs:
+        t0 = time.time()
+        neighbors, _ = top_neighbors(vectors, query_vecs, num_neighbors, exclude=queries, jobs=n_jobs)
+        seconds = time.time() - t0
+        if len(results) == 0:
+            reference = neighbors
+        results.append({'jobs': n_jobs, 'queries per second': len(queries) / seconds,
+                         'same neighbors': np.mean(neighbors == reference)})
+    results = pd.DataFrame(results)
+    results['speedup'] = results['queries per second'] / results['queries per second'][0]
+    results.to_csv(_results_fname('shard_scaling', vecs_fname), sep='\t', index=False)
+    return results
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='benchmark speed, memory, and accuracy trade-offs for word vectors')
+    argparser.add_argument('lang', help='language to benchmark in (uses two-letter ISO language codes)')
+    argparser.add_argument('vecs_fname', help='word vectors to benchmark')
+    argparser.add_argument('--precisions', nargs='+', default=['float64', 'float32', 'float16', 'int8'],
+                           help='storage precisions to compare')
+    argparser.add_argument('--ann_recall', action='store_true',
+                           help='compare approximate nearest neighbors to exact nearest neighbors, instead of comparing precisions')
+    argparser.add_argument('--dims', nargs='+', type=int,
+                           help='compare scores for vectors reduced to these numbers of dimensions, instead of comparing precisions')
+    argparser.add_argument('--shard_scaling', action='store_true',
+                           help='compare exact nearest neighbor search speed for different numbers of shards, instead of comparing precisions')
+    argparser.add_argument('--jobs', nargs='+', type=int, help='numbers of shards to compare (default is powers of 2 up to the number of cores)')
+    argparser.add_argument('--n', default=2e5, type=float, help='number of word vectors to load')
+    args = argparser.parse_args()
+
+    if args.ann_recall:
+        print(ann_recall(vecs_fname=args.vecs_fname, n=args.n))
+    elif args.dims is not None:
+        print(compare_dimensions(lang=args.lang, vecs_fname=args.vecs_fname, dims=args.dims, n=args.n))
+    elif args.shard_scaling:
+        print(shard_scaling(vecs_fname=args.vecs_fname, jobs=args.jobs, n=args.n))
+    else:
+        print(compare_precisions(lang=args.lang, vecs_fname=args.vecs_fname, precisions=args.precisions, n=args.n))
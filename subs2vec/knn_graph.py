@@ -0,0 +1,189 @@
+"""Compute and read the k-nearest neighbor graph for a whole vocabulary of word vectors."""
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import shutil
+import multiprocessing
+from .utensils import log_timer
+from .vecs import Vectors, _vocab_fname, _scales_fname
+from .lookup import _file_stamp
+from .neighbors import top_neighbors
+import logging
+logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
+
+
+def graph_prefix(vecs_fname):
+    """Gets the filename prefix for the kNN graph belonging to a set of word vectors.
+
+    :param vecs_fname: file containing word vectors
+    :return: filename prefix, the graph is stored in files starting with this prefix, next to the word vectors
+    """
+    return '.'.join(vecs_fname.split('.')[:-1]) + '.knn'
+
+
+def _tile_fnames(tiles_path, start):
+    return (os.path.join(tiles_path, f'{start}.neighbors.npy'),
+            os.path.join(tiles_path, f'{start}.similarities.npy'))
+
+
+def _save_atomic(fname, array):
+    # write to a temporary file first, so an interrupted write never looks like a completed tile
+    with open(f'{fname}.tmp', 'wb') as npyfile:
+        np.save(npyfile, array)
+    os.replace(f'{fname}.tmp', fname)
+
+
+_worker = {}
+
+
+def _init_worker(store_fname, n):
+    # each worker memory-maps the same binary store, so the vectors are shared through the page cache
+    _worker['vectors'] = Vectors(store_fname, n=n)
+
+
+def _compute_tile(task):
+    start, stop, num_neighbors, tiles_path, max_memory = task
+    vectors = _worker['vectors']
+    rows = np.arange(start, stop)
+    neighbors, similarities = top_neighbors(vectors, vectors.rows(rows), num_neighbors, exclude=rows, max_memory=max_memory)
+    neighbors_fname, similarities_fname = _tile_fnames(tiles_path, start)
+    _save_atomic(similarities_fname, similarities.astype(np.float16))
+    # the neighbors file is written last, so its presence marks the tile as completed
+    _save_atomic(neighbors_fname, neighbors.astype(np.int32))
+    return start
+
+
+@log_timer
+def build_graph(vecs_fname, num_neighbors=10, n=1e6, tile_rows=4096, jobs=1, max_memory=1e9):
+    """Computes the k-nearest neighbor graph (by cosine similarity) for every word in a set of word vectors.
+
+    The vocabulary is split into tiles of `tile_rows` target words, which are processed by a pool of worker processes.
+    Workers memory-map a normalized binary store of the vectors (the vectors file itself, if it is one, or else a store written next to the tiles).
+    Each completed tile is checkpointed to disk, so an interrupted build resumes where it left off when it is run again
+    (unless the parameters or the vectors file have changed since, in which case it starts over).
+    The finished graph is written to files starting with `graph_prefix(vecs_fname)`: an int32 array of neighbor rows,
+    a float16 array of similarities, and a vocab file. Open it with `KNNGraph`.
+
+    :param vecs_fname: file containing word vectors
+    :param num_neighbors: number of neighbors to find for each word, excluding the word itself (default is 10)
+    :param n: number of word vectors to include in the graph (default is 1e6)
+    :param tile_rows: number of target words per tile (default is 4096)
+    :param jobs: number of worker processes (default is 1)
+    :param max_memory: maximum size of the similarity matrix for a block of targets within a tile, in bytes (default is 1e9)
+    :return: filename prefix of the graph
+    """
+    prefix = graph_prefix(vecs_fname)
+    tiles_path = f'{prefix}.tiles'
+    params = f'{int(n)} {num_neighbors} {tile_rows}\n' + _file_stamp(vecs_fname)
+    params_fname = os.path.join(tiles_path, 'params')
+    if os.path.exists(tiles_path):
+        # tiles without a params file were left by a run interrupted while starting, so they are discarded too
+        same_params = False
+        if os.path.exists(params_fname):
+            with open(params_fname, 'r') as paramsfile:
+                same_params = paramsfile.read() == params
+        if not same_params:
+            logging.warning(f'discarding tiles in {tiles_path}, they were computed with different parameters or vectors')
+            shutil.rmtree(tiles_path)
+    if not os.path.exists(tiles_path):
+        os.mkdir(tiles_path)
+        # write to a temporary file first, so an interrupted write never looks like a complete params file
+        with open(f'{params_fname}.tmp', 'w') as paramsfile:
+            paramsfile.write(params)
+        os.replace(f'{params_fname}.tmp', params_fname)
+
+    # workers need a normalized binary store to memory-map
+    store_fname = os.path.join(tiles_path, 'vectors.npy')
+    if os.path.exists(_vocab_fname(store_fname)):
+        vectors = Vectors(store_fname, n=n)
+    else:
+        vectors = Vectors(vecs_fname, n=n)
+        if not (vecs_fname.endswith('.npy') and vectors.normalized):
+            vectors.normalize()
+            # write the store under temporary names and move the vocab file into place last, so its presence marks a complete store
+            tmp_fname = os.path.join(tiles_path, 'vectors.tmp.npy')
+            vectors.write_binary(tmp_fname)
+            os.replace(tmp_fname, store_fname)
+            if os.path.exists(_scales_fname(tmp_fname)):
+                os.replace(_scales_fname(tmp_fname), _scales_fname(store_fname))
+            os.replace(_vocab_fname(tmp_fname), _vocab_fname(store_fname))
+        else:
+            store_fname = vecs_fname
+
+    starts = range(0, vectors.n, tile_rows)
+    todo = [start for start in starts if not os.path.exists(_tile_fnames(tiles_path, start)[0])]
+    if len(todo) < len(starts):
+        logging.info(f'resuming, {len(starts) - len(todo)} out of {len(starts)} tiles already completed')
+    tasks = [(start, min(start + tile_rows, vectors.n), num_neighbors, tiles_path, max_memory) for start in todo]
+    if jobs > 1:
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(store_fname, n)) as pool:
+            for i, _ in enumerate(pool.imap_unordered(_compute_tile, tasks)):
+                logging.info(f'completed tile {i + 1} out of {len(tasks)}')
+    else:
+        _init_worker(store_fname, n)
+        for i, task in enumerate(tasks):
+            _compute_tile(task)
+            logging.info(f'completed tile {i + 1} out of {len(tasks)}')
+
+    # assemble tiles into the final arrays without holding the whole graph in memory
+    num_neighbors = min(num_neighbors, vectors.n - 1)
+    neighbors = np.lib.format.open_memmap(f'{prefix}.neighbors.npy', mode='w+', dtype=np.int32, shape=(vectors.n, num_neighbors))
+    similarities = np.lib.format.open_memmap(f'{prefix}.similarities.npy', mode='w+', dtype=np.float16, shape=(vectors.n, num_neighbors))
+    for start in starts:
+        neighbors_fname, similarities_fname = _tile_fnames(tiles_path, start)
+        tile = np.load(neighbors_fname)
+        neighbors[start:start + len(tile)] = tile
+        similarities[start:start + len(tile)] = np.load(similarities_fname)
+    neighbors.flush()
+    similarities.flush()
+    with open(f'{prefix}.vocab', 'w', encoding='utf-8') as vocabfile:
+        vocabfile.write(f'{vectors.n} {num_neighbors}\n')
+        vocabfile.write('\n'.join(vectors.words) + '\n')
+    _worker.clear()
+    shutil.rmtree(tiles_path)
+    logging.info(f'wrote {num_neighbors}-nearest neighbor graph for {len(neighbors)} words to {prefix}')
+    return prefix
+
+
+class KNNGraph:
+    """Reads a k-nearest neighbor graph computed by `build_graph()`.
+
+    The neighbor and similarity arrays are memory-mapped and words are looked up in a hash table,
+    so retrieving the neighbors of a word takes constant time regardless of the size of the vocabulary.
+
+    :param prefix: filename prefix of the graph (see `graph_prefix()`)
+    """
+    def __init__(self, prefix):
+        with open(f'{prefix}.vocab', 'r', encoding='utf-8') as vocabfile:
+            n, self.num_neighbors = [int(x) for x in next(vocabfile).split()]
+            self.words = np.array([next(vocabfile).rstrip('\n') for _ in range(n)], dtype=object)
+        # if a word occurs more than once, look up its first row
+        words = pd.Index(self.words)
+        first = ~words.duplicated(keep='first')
+        self._rows = pd.Series(np.flatnonzero(first), index=words[first])
+        self.neighbor_rows = np.load(f'{prefix}.neighbors.npy', mmap_mode='r')
+        self.similarities = np.load(f'{prefix}.similarities.npy', mmap_mode='r')
+
+    def neighbors(self, word, num_neighbors=None):
+        """Gets the nearest neighbors of a word.
+
+        :param word: word to get the neighbors of (raises KeyError if the word is not in the graph)
+        :param num_neighbors: number of neighbors to return (default is None, which returns all neighbors in the graph)
+        :return: pandas DataFrame containing neighbors and their similarities, sorted by similarity
+        """
+        row = self._rows[word]
+        neighbor_rows = self.neighbor_rows[row, :num_neighbors]
+        return pd.DataFrame({'neighbor': self.words[neighbor_rows], 'similarity': self.similarities[row, :num_neighbors].astype(np.float32)})
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='compute the k-nearest neighbor graph for all words in a set of word vectors')
+    argparser.add_argument('vecs_fname', help='word vectors to compute the graph for')
+    argparser.add_argument('--num_neighbors', default=10, type=int, help='number of neighbors to find for each word')
+    argparser.add_argument('--n', default=1e6, type=float, help='number of word vectors to include')
+    argparser.add_argument('--tile_rows', default=4096, type=int, help='number of target words per checkpointed tile')
+    argparser.add_argument('--jobs', default=1, type=int, help='number of worker processes')
+    args = argparser.parse_args()
+
+    build_graph(**vars(args))
@@ -1,27 +1,132 @@
 """Look up items in large lists of frequencies, norms, or vectors."""
 import argparse
+import os
+import csv
+import numpy as np
+import pandas as pd
+from .utensils import log_timer
+import logging
+logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
 
 
-def lookup(big_fname, items_fname):
+def lookup(big_fname, items_fname, use_index=False):
     """Line-wise Lookup of a list of items in a large file.
 
+    By default, every line that contains an item is written to the output file, which requires scanning the whole file.
+    With `use_index`, lines whose first field (e.g. the word in a .vec file or the n-gram in a frequencies file) exactly matches an item
+    are retrieved using a byte-offset index instead, which takes milliseconds once the index has been built.
+
     :param big_fname: filename of large file to look up items in
     :param items_fname: filename of list of items to look up
+    :param use_index: whether to look up exact matches using a byte-offset index (default is False)
     """
     out_fname = f'lookup.{items_fname}'
-    with open(big_fname, 'r') as big_file, open(items_fname, 'r') as items_file, open(out_fname, 'w') as out_file:
+    with open(items_fname, 'r') as items_file:
         items = items_file.read().split('\n')
         items = [item for item in items if item != '']
+    if use_index:
+        with open(out_fname, 'w', encoding='utf-8') as out_file:
+            out_file.writelines(lookup_lines(big_fname, items).values())
+    else:
+        with open(big_fname, 'r') as big_file, open(out_fname, 'w') as out_file:
+            for line in big_file:
+                for item in items:
+                    if item in line:
+                        out_file.write(line)
+
+
+def _index_fname(big_fname):
+    return f'{big_fname}.idx'
+
+
+def _file_stamp(big_fname):
+    # size and modification time identify the version of a file an index was built for
+    stat = os.stat(big_fname)
+    return f'# {stat.st_size} {stat.st_mtime_ns}\n'
+
+
+@log_timer
+def build_index(big_fname):
+    """Builds a byte-offset index for a large file in a single streaming pass.
+
+    The index maps the first field on each line (split on tabs for .tsv files and on spaces otherwise) to the byte offset of that line.
+    The first line of the file is treated as a header and skipped.
+    The index is written to a sidecar file (`big_fname` + .idx), stamped with the size and modification time of the indexed file.
+
+    :param big_fname: filename of large file to index
+    :return: pandas DataFrame with columns `offset` and `row`, indexed by key
+    """
+    sep = b'\t' if big_fname.endswith('.tsv') else b' '
+    keys = []
+    offsets = []
+    with open(big_fname, 'rb') as big_file:
+        offset = len(big_file.readline())  # skip header
         for line in big_file:
-            for item in items:
-                if item in line:
-                    out_file.write(line)
+            keys.append(line.split(sep, 1)[0].rstrip(b'\r\n').decode('utf-8'))
+            offsets.append(offset)
+            offset += len(line)
+    index = pd.DataFrame({'offset': np.array(offsets, dtype=np.int64)}, index=pd.Index(keys, name='key'))
+    # write to a temporary file first, so an interrupted or concurrent write never looks like a complete index
+    index_fname = _index_fname(big_fname)
+    tmp_fname = f'{index_fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'w', encoding='utf-8') as index_file:
+        index_file.write(_file_stamp(big_fname))
+        index.to_csv(index_file, sep='\t', quoting=csv.QUOTE_NONE)
+    os.replace(tmp_fname, index_fname)
+    index['row'] = np.arange(len(index))
+    return index
+
+
+def load_index(big_fname):
+    """Loads the byte-offset index for a large file, building it first if it does not exist or is out of date.
+
+    :param big_fname: filename of large file to load the index for
+    :return: pandas DataFrame with columns `offset` and `row`, indexed by key
+    """
+    index_fname = _index_fname(big_fname)
+    if os.path.exists(index_fname):
+        with open(index_fname, 'r', encoding='utf-8') as index_file:
+            if index_file.readline() == _file_stamp(big_fname):
+                index = pd.read_csv(index_file, sep='\t', index_col='key', dtype={'key': str, 'offset': np.int64},
+                                    quoting=csv.QUOTE_NONE, na_filter=False)
+                index['row'] = np.arange(len(index))
+                return index
+        logging.info(f'{big_fname} has changed since {index_fname} was built')
+    logging.info(f'building byte-offset index for {big_fname}')
+    return build_index(big_fname)
+
+
+def lookup_lines(big_fname, keys, index=None):
+    """Looks up lines by key in a large file, using a byte-offset index.
+
+    If a key occurs more than once, the first line is returned.
+
+    :param big_fname: filename of large file to look up lines in
+    :param keys: list of keys to look up
+    :param index: byte-offset index as returned by `load_index()` (default is None, which loads the index)
+    :return: dict mapping each key that was found to its line, in the order of `keys`
+    """
+    keys = list(keys)
+    if index is None:
+        index = load_index(big_fname)
+    index = index.loc[~index.index.duplicated(keep='first')]
+    positions = index.index.get_indexer(pd.Index(keys, dtype=object))
+    offsets = index['offset'].values
+    lines = {}
+    with open(big_fname, 'rb') as big_file:
+        # seek in file order, then restore the order of the keys
+        for i in sorted(np.flatnonzero(positions >= 0), key=lambda i: offsets[positions[i]]):
+            big_file.seek(offsets[positions[i]])
+            lines[keys[i]] = big_file.readline().decode('utf-8')
+    return {key: lines[key] for key in keys if key in lines}
 
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(description='count words in files in a given directory')
     argparser.add_argument('big_fname', help='large file to look up items in')
     argparser.add_argument('items_fname', help='file containing list of items to look up')
+    argparser.add_argument('--use_index', action='store_true',
+                           help='look up exact matches using a byte-offset index (builds the index on first use)')
     args = argparser.parse_args()
-    
+
     lookup(**vars(args))
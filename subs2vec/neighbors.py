@@ -3,97 +3,257 @@ import numpy as np
 import pandas as pd
 import argparse
 import os
+import concurrent.futures
 import sklearn.decomposition
+from threadpoolctl import threadpool_limits
 from .utensils import log_timer
 from .vecs import Vectors
+from .lookup import _file_stamp
 import logging
 logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
 path = os.path.dirname(__file__)
 
 
-@log_timer
-def compute_nn(vectors, target_vecs, target_labels, num_neighbors=-1, whole_matrix=False):
-    """Solves analogies using specified methods.
+def _block_size(n_rows, n_targets, itemsize, max_memory):
+    # number of targets for which a rows-by-targets similarity matrix fits in max_memory bytes
+    return int(max(1, min(n_targets, max_memory // (n_rows * itemsize))))
+
+
+def _scatter_exclude(scores, excluded, first_row):
+    # set the scores of excluded rows that fall within a block of rows starting at first_row to -inf (-1 excludes nothing)
+    hits = (excluded >= first_row) & (excluded < first_row + len(scores))
+    scores[excluded[hits] - first_row, np.flatnonzero(hits)] = -np.inf
+
+
+def _shard_top(vectors, score, start, stop, num_neighbors, block_rows):
+    # score rows start:stop in blocks, keeping only the top rows of each block for each target (selected by partial sorting)
+    candidates = []
+    scores = []
+    for block_start in range(start, stop, block_rows):
+        block = score(vectors.rows(slice(block_start, min(block_start + block_rows, stop))), block_start).T
+        k = min(num_neighbors, block.shape[1])
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        candidates.append(top + block_start)
+        scores.append(np.take_along_axis(block, top, axis=1))
+    return np.concatenate(candidates, axis=1), np.concatenate(scores, axis=1)
+
+
+def sharded_top(vectors, score, num_neighbors=10, jobs=1, block_rows=65536, n_rows=None):
+    """Finds the highest scoring word vectors for a set of targets, searching shards of the vocabulary in parallel.
+
+    The vocabulary is split into `jobs` contiguous shards of rows, which are scored by a pool of threads sharing the vectors in memory.
+    Each thread scores its shard in blocks of rows and keeps the top rows of each block, after which the results of all blocks are merged.
+    While searching in parallel, BLAS is limited to one thread per shard, so the shards do not compete for cores.
 
     :param vectors: Vectors object containing word vectors
-    :param whole_matrix: boolean determining whether to use whole matrix multiplication (faster, but uses more RAM than you may have available, `False` is the default)
-    :return: dict containing score and predictions in separate pandas DataFrames
+    :param score: function that takes a block of word vectors and the row index of its first row, and returns an array of scores with rows in rows and targets in columns
+    :param num_neighbors: number of top scoring rows to find for each target (default is 10)
+    :param jobs: number of shards to search in parallel (default is 1)
+    :param block_rows: number of rows to score at once within a shard (default is 65536)
+    :param n_rows: number of rows to search, starting from the first row (default is None, which searches all rows)
+    :return: tuple of numpy arrays containing row indices and scores of the top rows, with targets in rows, sorted by score
+    """
+    n_rows = vectors.n if n_rows is None else min(n_rows, vectors.n)
+    bounds = np.linspace(0, n_rows, max(1, min(jobs, n_rows)) + 1).astype(int)
+    shards = list(zip(bounds[:-1], bounds[1:]))
+    if len(shards) > 1:
+        with concurrent.futures.ThreadPoolExecutor(len(shards)) as executor, threadpool_limits(limits=1, user_api='blas'):
+            results = list(executor.map(lambda shard: _shard_top(vectors, score, *shard, num_neighbors, block_rows), shards))
+    else:
+        results = [_shard_top(vectors, score, 0, n_rows, num_neighbors, block_rows)]
+
+    # merge the top rows of all shards
+    candidates = np.concatenate([rows for rows, _ in results], axis=1)
+    scores = np.concatenate([shard_scores for _, shard_scores in results], axis=1)
+    num_neighbors = min(num_neighbors, candidates.shape[1])
+    top = np.argpartition(-scores, num_neighbors - 1, axis=1)[:, :num_neighbors]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(candidates, np.take_along_axis(top, order, axis=1), axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def top_neighbors(vectors, target_vecs, num_neighbors=10, exclude=None, max_memory=1e9, jobs=1, densities=None):
+    """Finds the nearest neighbors (by cosine similarity) of a set of target vectors.
+
+    Targets are processed in blocks, sized so that each block's similarity matrix fits in `max_memory` bytes,
+    and the nearest neighbors in each block are selected by partial sorting (argpartition) rather than a full sort.
+    With `jobs` > 1, each block is searched in parallel over shards of the vocabulary (see `sharded_top()`).
+    If neighborhood densities are passed, neighbors are ranked by cross-domain similarity local scaling (CSLS) instead,
+    scoring each candidate as 2 * cosine similarity - the candidate's density, which penalizes hub words that are close to many other words.
+    (The target's own density is the same for all of its candidates, so it is left out.)
+
+    :param vectors: Vectors object containing word vectors (should be normalized to unit length)
+    :param target_vecs: numpy array containing target vectors in rows
+    :param num_neighbors: number of neighbors to find for each target (default is 10)
+    :param exclude: numpy array containing a row index to exclude for each target, e.g. the target word itself (-1 excludes nothing)
+    :param max_memory: maximum size of the similarity matrix for a block of targets, in bytes (default is 1e9)
+    :param jobs: number of vocabulary shards to search in parallel (default is 1)
+    :param densities: numpy array containing the neighborhood density of each word vector, see `neighborhood_densities()` (default is None, which ranks by cosine similarity)
+    :return: tuple of numpy arrays containing row indices and similarities (or CSLS scores) of the neighbors, with targets in rows, sorted by similarity
+    """
+    target_vecs = np.asarray(target_vecs, dtype=vectors.compute_dtype)
+    num_neighbors = min(num_neighbors, vectors.n - (exclude is not None))
+    n_targets = len(target_vecs)
+    neighbors = np.zeros((n_targets, num_neighbors), dtype=np.int64)
+    similarities = np.zeros((n_targets, num_neighbors), dtype=vectors.compute_dtype)
+    block = _block_size(vectors.n, n_targets, np.dtype(vectors.compute_dtype).itemsize, max_memory)
+    for start in range(0, n_targets, block):
+        stop = min(start + block, n_targets)
+        targets = target_vecs[start:stop]
+        excluded = None if exclude is None else exclude[start:stop]
+
+        def score(rows, first_row):
+            sims = np.matmul(rows, targets.T)
+            if densities is not None:
+                sims = 2.0 * sims - densities[first_row:first_row + len(rows), np.newaxis]
+            if excluded is not None:
+                _scatter_exclude(sims, excluded, first_row)
+            return sims
+
+        neighbors[start:stop], similarities[start:stop] = sharded_top(vectors, score, num_neighbors, jobs)
+    return neighbors, similarities
+
+
+def csls_fname(vecs_fname, k=10):
+    """Gets the filename of the cached neighborhood densities belonging to a set of word vectors.
+
+    :param vecs_fname: file containing word vectors
+    :param k: number of nearest neighbors the densities are computed over (default is 10)
+    :return: filename of the .npy file the densities are cached in, next to the word vectors
+    """
+    return '.'.join(vecs_fname.split('.')[:-1]) + f'.csls{k}.npy'
+
+
+@log_timer
+def neighborhood_densities(vectors, k=10, cache_fname=None, graph=None, jobs=1, max_memory=1e9, block_targets=65536, vecs_fname=None):
+    """Computes the neighborhood density of each word vector, the mean cosine similarity to its k nearest neighbors.
+
+    These are the penalty terms for cross-domain similarity local scaling (CSLS) retrieval.
+    Computing them takes a nearest neighbor pass over the whole vocabulary, so they can be cached in a .npy file (see `csls_fname()`).
+    A cached file is reused if it covers the same vocabulary and, if `vecs_fname` is given, was computed for the same version of the vectors file
+    (identified by its size and modification time, stored in a .stamp file next to the cache), otherwise it is recomputed.
+    Vectors restricted to a vocabulary (see `Vectors()`) reuse the cached densities of the full vocabulary they were loaded from.
+
+    :param vectors: Vectors object containing word vectors (should be normalized to unit length)
+    :param k: number of nearest neighbors to average over (default is 10)
+    :param cache_fname: .npy file to load cached densities from or save computed densities to (default is None, which does not cache)
+    :param graph: KNNGraph for the word vectors with at least k neighbors per word, to take the similarities from (default is None, which searches for neighbors)
+    :param jobs: number of vocabulary shards to search in parallel (default is 1)
+    :param max_memory: maximum size of the similarity matrix for a block of targets, in bytes (default is 1e9)
+    :param block_targets: number of words to find neighbors for at once (default is 65536)
+    :param vecs_fname: file the word vectors were loaded from, to check that cached densities are up to date (default is None, which does not check)
+    :return: numpy array containing the neighborhood density of each word vector
     """
-    missing = 0
-    total = len(target_labels)
-    vecs_dict = vectors.as_dict()
+    stamp = None if vecs_fname is None else _file_stamp(vecs_fname)
+    if (cache_fname is not None) and os.path.exists(cache_fname):
+        densities = np.load(cache_fname)
+        cached_stamp = None
+        if os.path.exists(f'{cache_fname}.stamp'):
+            with open(f'{cache_fname}.stamp', 'r') as stampfile:
+                cached_stamp = stampfile.read()
+        if (len(densities) == vectors.vocab_size) and (stamp is None or cached_stamp == stamp):
+            return densities[vectors.ranks]
+        logging.info(f'{cache_fname} does not match the vectors, recomputing neighborhood densities')
+    if vectors.n != vectors.vocab_size:
+        raise ValueError('neighborhood densities must be computed on the full vocabulary, load the vectors without restricting the vocabulary')
 
+    if graph is not None:
+        densities = np.mean(np.asarray(graph.similarities[:, :k], dtype=np.float32), axis=1)
+    else:
+        densities = np.empty(vectors.n, dtype=np.float32)
+        for start in range(0, vectors.n, block_targets):
+            rows = np.arange(start, min(start + block_targets, vectors.n))
+            _, similarities = top_neighbors(vectors, vectors.rows(rows), k, exclude=rows, max_memory=max_memory, jobs=jobs)
+            densities[rows] = similarities.mean(axis=1)
+    if cache_fname is not None:
+        np.save(cache_fname, densities)
+        if stamp is not None:
+            with open(f'{cache_fname}.stamp', 'w') as stampfile:
+                stampfile.write(stamp)
+        elif os.path.exists(f'{cache_fname}.stamp'):
+            os.remove(f'{cache_fname}.stamp')
+    return densities
+
+
+@log_timer
+def compute_nn(vectors, target_vecs=None, target_labels=None, num_neighbors=1, whole_matrix=False, max_memory=1e9, index=None, n_probe=8, jobs=1, densities=None):
+    """Finds nearest neighbors for words or vectors.
+
+    When looking up words, the target word itself is excluded from its neighbors.
+    If an approximate nearest neighbor index (see `subs2vec.ann.IVFIndex`) is passed, neighbors are retrieved from the index instead.
+    If neighborhood densities are passed, neighbors are retrieved by CSLS score instead of cosine similarity (see `top_neighbors()`).
+
+    :param vectors: Vectors object containing word vectors (should be normalized to unit length)
+    :param target_vecs: numpy array containing vectors to find neighbors for in rows (default is None, which looks up `target_labels` as words)
+    :param target_labels: labels for the target vectors, or words to find neighbors for if `target_vecs` is None
+    :param num_neighbors: number of neighbors to find for each target (default is 1)
+    :param whole_matrix: boolean determining whether to compute similarities for all targets at once (faster, but uses more RAM than you may have available, `False` is the default)
+    :param max_memory: maximum size of the similarity matrix for a block of targets in bytes, if not using `whole_matrix` (default is 1e9)
+    :param index: IVFIndex built for the word vectors, to use for approximate search (default is None, which uses exact search)
+    :param n_probe: number of index lists to search for each target, if using an index (default is 8)
+    :param jobs: number of vocabulary shards to search in parallel, if using exact search (default is 1)
+    :param densities: numpy array containing the neighborhood density of each word vector, see `neighborhood_densities()` (default is None, which ranks by cosine similarity)
+    :return: pandas DataFrame containing targets, and neighbors and their similarities (or CSLS scores) in numbered columns
+    """
+    if (index is not None) and (densities is not None):
+        raise ValueError('CSLS retrieval is only available for exact search, not for search using an index')
+    exclude = None
     if target_vecs is None:
-        targets = target_labels
-        target_labels = []
-        target_vecs = []
-        for target in targets:
-            if target in vecs_dict.keys():
-                target_labels.append(target)
-                target_vecs.append(vecs_dict[target])
-            else:
-                missing += 1
-        target_vecs = np.vstack(target_vecs)
-        target_labels = np.vstack(target_labels)
-    l = len(target_vecs)
-
-    # cosine similarity (assumes vectors are normalized to unit length)
-    def cos(a, b):
-        return np.matmul(a, b.T)
-
-    # alternate formulation for cosine similarity (assumes vectors are normalized to unit length)
-    def cos_pos(a, b):
-        return (1.0 + np.matmul(a, b.T)) / 2.0
-
-    if whole_matrix:
-        logging.info('computing analogies using whole matrix additive method')
-        nn_pred = cos(vectors.vectors, target_vecs)
-        nn_pred_idx = np.argmax(nn_pred, axis=0)
-        if num_neighbors == -1:
-            nn_pred_idx = np.argsort(nn_pred, axis=0)[num_neighbors]
-            colnames = 'neighbor'
-        else:
-            argsorted = np.argsort(nn_pred, axis=0)[::-1]
-            nn_pred_idx = np.vstack([argsorted[:num_neighbors], argsorted[-num_neighbors:]])
-            colnames = ['neighbor ' + str(i) for i in range(num_neighbors)] + ['neighbor ' + str(i) for i in range(-num_neighbors, 0)]
+        idx, missing_words = vectors.indices(target_labels)
+        if missing_words.any():
+            logging.info(f'missing vectors for {missing_words.sum()} out of {len(target_labels)} words')
+        exclude = idx[~missing_words]
+        target_vecs = vectors.rows(exclude)
+        target_labels = np.array(target_labels, dtype=object)[~missing_words]
+
+    if index is not None:
+        neighbors, similarities = index.search(vectors, target_vecs, num_neighbors, n_probe, exclude)
     else:
-        logging.info('computing analogies using linewise additive method')
-        nn_pred_idx = np.zeros(l, dtype=np.int32)
-        for i in range(l):
-            nn_pred = cos(vectors.vectors, target_vecs[i]).reshape(1, -1).squeeze()
-            nn_pred_idx[i] = np.argmax(nn_pred)
+        if whole_matrix:
+            max_memory = np.inf
+        neighbors, similarities = top_neighbors(vectors, target_vecs, num_neighbors, exclude, max_memory, jobs, densities)
 
     # return pandas df with nearest neighbors
-    results = vectors.words[nn_pred_idx]
-    neighbors = pd.DataFrame(np.hstack([target_labels.reshape(-1, 1), results.T]), columns=['target'] + colnames)
-
-    return neighbors
+    results = pd.DataFrame({'target': target_labels})
+    score = 'similarity' if densities is None else 'csls'
+    for i in range(neighbors.shape[1]):
+        results[f'neighbor {i + 1}'] = vectors.words[neighbors[:, i]]
+        results[f'{score} {i + 1}'] = similarities[:, i]
+    return results
 
 
-def find_nn(vecs_fname, items_fname, num_neighbors=-1, whole_matrix=False, items_are_vecs=True):
-    """Solve novel analogies, using word vectors.
+def find_nn(vecs_fname, items_fname, num_neighbors=1, whole_matrix=False, items_are_vecs=False, n=1e6, jobs=1, csls=0):
+    """Find nearest neighbors for words or vectors.
 
-    Writes predictions to tab-separated text file.
+    Writes neighbors to tab-separated text file.
 
-    :param vecs_fname: file containing word vectors to use for prediction.
-    :param analogies_fname: file containing analogies in tab-separated columns named 'a1', 'a2', and 'b1'
-    :param method: solving method to use (options are `additive` and `multiplicative`, multiplicative is the default and usually performs best)
-    :param whole_matrix: boolean determining whether to use whole matrix multiplication (faster, but uses more RAM than you may have available, `False` is the default)
+    :param vecs_fname: file containing word vectors to find neighbors in
+    :param items_fname: file containing words in a tab-separated column named 'words',
+    or if `items_are_vecs` is True, labeled vectors in .vec format (a label followed by space-separated values on each line, without header)
+    :param num_neighbors: number of neighbors to find for each item (default is 1)
+    :param whole_matrix: boolean determining whether to compute similarities for all items at once (faster, but uses more RAM than you may have available, `False` is the default)
+    :param items_are_vecs: whether the items are vectors rather than words (default is False)
+    :param n: number of word vectors to search (default is 1e6)
+    :param jobs: number of vocabulary shards to search in parallel (default is 1)
+    :param csls: number of nearest neighbors to compute neighborhood densities over for CSLS retrieval,
+    densities are cached next to the word vectors (default is 0, which retrieves neighbors by cosine similarity)
     """
-    logging.info(f'solving novel analogies with {vecs_fname}')
-    vectors = Vectors(vecs_fname, normalize=True, n=3e3, d=300)
+    logging.info(f'finding nearest neighbors with {vecs_fname}')
+    vectors = Vectors(vecs_fname, normalize=True, n=n)
     if items_are_vecs:
-        #targets = np.loadtxt(items_fname)
-        #target_labels = targets[:, 0]
-        #target_vecs = targets[:, 1:]
-        d = 300
-        target_vecs = pca_vecs(vectors.vectors, d)
-        target_labels = np.array(list(range(d)))
+        targets = np.loadtxt(items_fname, dtype=str, comments=None, ndmin=2)
+        target_labels = targets[:, 0]
+        target_vecs = targets[:, 1:].astype(vectors.compute_dtype)
+        target_vecs = target_vecs / np.linalg.norm(target_vecs, axis=1).reshape(-1, 1)
     else:
         targets = pd.read_csv(items_fname, sep='\t', comment='#')
         target_labels = list(targets['words'])
         target_vecs = None
-    neighbors = compute_nn(vectors, target_vecs=target_vecs, target_labels=target_labels, num_neighbors=num_neighbors, whole_matrix=whole_matrix)
+    densities = None
+    if csls > 0:
+        densities = neighborhood_densities(vectors, csls, cache_fname=csls_fname(vecs_fname, csls), vecs_fname=vecs_fname, jobs=jobs)
+    neighbors = compute_nn(vectors, target_vecs=target_vecs, target_labels=target_labels, num_neighbors=num_neighbors,
+                           whole_matrix=whole_matrix, jobs=jobs, densities=densities)
     base_fname = '.'.join(items_fname.split('.')[:-1])
     neighbors.to_csv(f'{base_fname}.neighbors.tsv', sep='\t', index=False)
 
@@ -110,7 +270,11 @@ if __name__ == '__main__':
     argparser.add_argument('items_fname', help='file containing words or vectors to find nearest neighbors for')
     argparser.add_argument('num_neighbors', type=int, help='number of neighbors to retrieve')
     argparser.add_argument('--whole_matrix', action='store_true',
-                           help='perform computations using whole matrices instead of column-wise (potentially results in big memory footprint)')
+                           help='perform computations using whole matrices instead of blockwise (potentially results in big memory footprint)')
+    argparser.add_argument('--items_are_vecs', action='store_true', help='items file contains labeled vectors instead of words')
+    argparser.add_argument('--jobs', default=1, type=int, help='number of vocabulary shards to search in parallel')
+    argparser.add_argument('--csls', default=0, type=int,
+                           help='retrieve neighbors by CSLS score, with neighborhood densities computed over this many neighbors (cached for reuse)')
     args = argparser.parse_args()
 
     find_nn(**vars(args))
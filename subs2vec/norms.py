@@ -4,25 +4,31 @@ import pandas as pd
 import sklearn.linear_model
 import sklearn.model_selection
 import sklearn.preprocessing
-import sklearn.utils
+import joblib
 import argparse
 import os
-from .vecs import Vectors
+import time
+from .vecs import Vectors, dataset_vocab, _scores_fname
 from .utensils import log_timer
 import logging
 logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
 path = os.path.dirname(__file__)
+alpha_grid = np.logspace(-3, 3, 25)  # candidate regularization strengths for alpha='auto'
 
 
 @log_timer
-def evaluate_norms(lang, vecs_fname, alpha=1.0):
+def evaluate_norms(lang, vecs_fname, alpha=1.0, jobs=1, seed=0):
     """Predict lexical norms to evaluate a set of word vectors in a given language.
     
+    Features are gathered for all norms datasets first, after which the datasets are cross-validated in parallel (see `predict_norms()`).
     Writes scores to tab-separated text file but also returns them.
 
     :param lang: language to evaluate word vectors in (uses two-letter ISO codes)
     :param vecs_fname: word vectors to evaluate
-    :param alpha: regularization strength, default 1.0, set higher for small datasets
+    :param alpha: regularization strength, default 1.0, set higher for small datasets, or 'auto' to choose it for each norm
+    (the leave-one-out scores for every candidate alpha are written to a separate file)
+    :param jobs: number of worker processes to cross-validate with (default is 1)
+    :param seed: random seed for shuffling and splitting the norms (default is 0)
     :return: pandas DataFrame containing the norms results
     """
     norms_path = os.path.join(path, 'datasets', 'norms')
@@ -32,56 +38,171 @@ def evaluate_norms(lang, vecs_fname, alpha=1.0):
     if not os.path.exists(results_path):
         os.mkdir(results_path)
     logging.info(f'evaluating lexical norm prediction with {vecs_fname}')
-    vectors = Vectors(vecs_fname, normalize=True, n=1e6, d=300)
-    scores = []
-    for norms_fname in os.listdir(norms_path):
+    vectors = Vectors(vecs_fname, normalize=True, n=1e6, vocab=dataset_vocab(lang, ['norms']))
+    norms_fnames = []
+    datasets = []
+    for norms_fname in sorted(os.listdir(norms_path)):
         if norms_fname.startswith(lang):
-            logging.info(f'predicting norms from {norms_fname}')
+            logging.info(f'gathering features for {norms_fname}')
             norms = pd.read_csv(os.path.join(norms_path, norms_fname), sep='\t', comment='#')
             norms = norms.set_index('word')
-            score = predict_norms(vectors, norms, alpha)['scores']
-            score['source'] = norms_fname
-            scores.append(score)
-    scores_fname = os.path.split(vecs_fname)[1].replace('.vec', '.tsv')
+            norms_fnames.append(norms_fname)
+            datasets.append(_gather_features(vectors, norms, seed))
+    scores = []
+    curves = []
+    cv_results = _cross_validate([(x, y) for _, x, y, _ in datasets], alpha, jobs, seed)
+    for norms_fname, (df, _, _, penalty), (cv_scores, alphas, curve) in zip(norms_fnames, datasets, cv_results):
+        score = _score_table(df.columns.values, cv_scores, penalty, alphas)
+        score['source'] = norms_fname
+        scores.append(score)
+        if curve is not None:
+            curve = _curve_table(df.columns.values, curve)
+            curve['source'] = norms_fname
+            curves.append(curve)
+    scores_fname = _scores_fname(vecs_fname)
+    if len(curves) > 0:
+        curves_fname = scores_fname[:-len('.tsv')] + '.alphas.tsv'
+        pd.concat(curves).to_csv(os.path.join(results_path, curves_fname), sep='\t', index=False)
     if len(scores) > 0:
         scores = pd.concat(scores)
         scores.to_csv(os.path.join(results_path, scores_fname), sep='\t', index=False)
         return scores
 
 
-@log_timer
-def predict_norms(vectors, norms, alpha=1.0):
-    """Predict lexical norms and return score.
-
-    :param vectors: Vectors object containing word vectors
-    :param norms: pandas DataFrame of lexical norms
-    :param alpha: regularization strength, default 1.0, set higher for small datasets
-    :return: dict containing scores and predictions in separate pandas DataFrames
-    """
-    vecs_df = vectors.as_df()
-    cols = norms.columns.values
-    df = norms.join(vecs_df, how='inner')
+def _gather_features(vectors, norms, seed=0):
+    # look up the word vectors for the norms, gathering only those rows, in random order (shuffle is important for unbiased results on ordered datasets!)
+    # returns the norms of words with vectors, features and norms as float64 arrays, and the penalty for words without vectors
+    idx, missing = vectors.indices(norms.index)
     # compensate for missing ys somehow
     total = len(norms)
-    missing = len(norms) - len(df)
-    penalty = (total - missing) / total
-    logging.info(f'missing vectors for {missing} out of {total} words')
-    df = sklearn.utils.shuffle(df)  # shuffle is important for unbiased results on ordered datasets!
+    penalty = (total - missing.sum()) / total
+    logging.info(f'missing vectors for {missing.sum()} out of {total} words')
+    order = np.flatnonzero(~missing)
+    np.random.RandomState(seed).shuffle(order)
+    x = vectors.rows(idx[order]).astype(np.float64)
+    y = norms.values[order].astype(np.float64)
+    return norms.iloc[order], x, y, penalty
+
+
+def _ridge_cv(x, y, alphas, cv):
+    # cross-validate ridge regression (with intercept) for every column of y and every alpha at once
+    # each training fold is decomposed once, after which a solution for any column and alpha only takes a matrix product
+    # returns an array of test fold r-squared scores, shaped (folds, columns, alphas)
+    scores = np.zeros((cv.get_n_splits(), y.shape[1], len(alphas)))
+    gram = np.matmul(x.T, x)
+    xty = np.matmul(x.T, y)
+    x_sum = x.sum(axis=0)
+    y_sum = y.sum(axis=0)
+    for i, (train, test) in enumerate(cv.split(x)):
+        x_test = x[test]
+        y_test = y[test]
+        n = len(train)
+        x_mean = (x_sum - x_test.sum(axis=0)) / n
+        y_mean = (y_sum - y_test.sum(axis=0)) / n
+        if n > x.shape[1]:
+            # centered X'X and X'y of the training rows, obtained by taking the test rows out of X'X and X'y for all rows
+            xtx_train = gram - np.matmul(x_test.T, x_test) - n * np.outer(x_mean, x_mean)
+            xty_train = xty - np.matmul(x_test.T, y_test) - n * np.outer(x_mean, y_mean)
+            eigenvalues, eigenvectors = np.linalg.eigh(xtx_train)
+            y_train = np.matmul(eigenvectors.T, xty_train)
+            x_test = np.matmul(x_test - x_mean, eigenvectors)
+        else:
+            # fewer rows than dimensions, so decompose XX' instead
+            x_train = x[train] - x_mean
+            eigenvalues, eigenvectors = np.linalg.eigh(np.matmul(x_train, x_train.T))
+            y_train = np.matmul(eigenvectors.T, y[train] - y_mean)
+            x_test = np.matmul(np.matmul(x_test - x_mean, x_train.T), eigenvectors)
+        # drop directions without variance, so alpha=0 gives the minimum norm least squares solution
+        nonzero = eigenvalues > eigenvalues[-1] * max(x.shape) * np.finfo(np.float64).eps
+        eigenvalues, y_train, x_test = eigenvalues[nonzero], y_train[nonzero], x_test[:, nonzero]
+
+        ss_total = ((y_test - y_test.mean(axis=0)) ** 2).sum(axis=0)
+        for j, alpha in enumerate(alphas):
+            y_predicted = np.matmul(x_test, y_train / (eigenvalues + alpha)[:, np.newaxis]) + y_mean
+            scores[i, :, j] = 1.0 - ((y_test - y_predicted) ** 2).sum(axis=0) / ss_total
+    return scores
+
+
+def _ridge_loo(x, y, alphas):
+    # leave-one-out cross-validate ridge regression (with intercept) for every column of y and every alpha at once
+    # uses a single decomposition of x, since leave-one-out residuals are the residuals of the full fit divided by (1 - leverage)
+    # returns an array of leave-one-out r-squared scores, shaped (columns, alphas)
+    n = len(x)
+    x = x - x.mean(axis=0)
+    y = y - y.mean(axis=0)
+    if n > x.shape[1]:
+        eigenvalues, eigenvectors = np.linalg.eigh(np.matmul(x.T, x))
+    else:
+        eigenvalues, u = np.linalg.eigh(np.matmul(x, x.T))
+    nonzero = eigenvalues > eigenvalues[-1] * max(x.shape) * np.finfo(np.float64).eps
+    eigenvalues = eigenvalues[nonzero]
+    if n > x.shape[1]:
+        u = np.matmul(x, eigenvectors[:, nonzero]) / np.sqrt(eigenvalues)  # left singular vectors of x
+    else:
+        u = u[:, nonzero]
+    uty = np.matmul(u.T, y)
+    u_squared = u ** 2
+
+    scores = np.zeros((y.shape[1], len(alphas)))
+    ss_total = (y ** 2).sum(axis=0)
+    for j, alpha in enumerate(alphas):
+        shrinkage = eigenvalues / (eigenvalues + alpha)
+        residuals = y - np.matmul(u, shrinkage[:, np.newaxis] * uty)
+        leverage = 1.0 / n + np.matmul(u_squared, shrinkage)  # the intercept adds 1/n to the leverage of every row
+        scores[:, j] = 1.0 - ((residuals / (1.0 - leverage)[:, np.newaxis]) ** 2).sum(axis=0) / ss_total
+    return scores
+
+
+def _cross_validate_group(x, y, alpha, cv):
+    # cross-validate a group of norms with the same missing values
+    # if alpha is 'auto', choose alpha for each norm by leave-one-out cross-validation on all observed words first
+    # returns test fold r-squared scores shaped (folds, columns), the alpha for each column, and the leave-one-out curve (or None)
+    if alpha == 'auto':
+        curve = _ridge_loo(x, y, alpha_grid)
+        best = curve.argmax(axis=1)
+        cv_scores = _ridge_cv(x, y, alpha_grid, cv)[:, np.arange(y.shape[1]), best]
+        return cv_scores, alpha_grid[best], curve
+    return _ridge_cv(x, y, [alpha], cv)[:, :, 0], np.full(y.shape[1], alpha), None
+
 
-    model = sklearn.linear_model.Ridge(alpha=alpha)  # use ridge regression models
-    cv = sklearn.model_selection.RepeatedKFold(n_splits=5, n_repeats=10)
+def _cross_validate(datasets, alpha, jobs=1, seed=0):
+    # cross-validate a list of (x, y) datasets, with a parallel task for each group of norms with the same missing values
+    # only the gathered features of each group are sent to the worker processes, and results are collected in task order
+    # returns a list of (cv scores, alphas, curve) tuples, one for each dataset, see _cross_validate_group()
+    cv = sklearn.model_selection.RepeatedKFold(n_splits=5, n_repeats=10, random_state=seed)
+    tasks = []
+    for i, (x, y) in enumerate(datasets):
+        patterns, pattern_idx = np.unique(~np.isnan(y), axis=1, return_inverse=True)
+        pattern_idx = pattern_idx.ravel()
+        for j in range(patterns.shape[1]):
+            tasks.append((i, patterns[:, j], pattern_idx == j))
+    results = joblib.Parallel(n_jobs=jobs)(
+        joblib.delayed(_cross_validate_group)(*_observed(datasets[i][0], datasets[i][1][:, group], observed), alpha, cv)
+        for i, observed, group in tasks
+    )
+    cv_scores = [np.zeros((cv.get_n_splits(), y.shape[1])) for _, y in datasets]
+    alphas = [np.zeros(y.shape[1]) for _, y in datasets]
+    curves = [np.zeros((y.shape[1], len(alpha_grid))) if alpha == 'auto' else None for _, y in datasets]
+    for (i, _, group), (group_scores, group_alphas, group_curve) in zip(tasks, results):
+        cv_scores[i][:, group] = group_scores
+        alphas[i][group] = group_alphas
+        if group_curve is not None:
+            curves[i][group] = group_curve
+    return list(zip(cv_scores, alphas, curves))
 
-    # compute crossvalidated prediction scores
+
+def _observed(x, y, observed):
+    # select the rows of x and y where y is observed, without copying if it is observed everywhere
+    if observed.all():
+        return x, y
+    return x[observed], y[observed]
+
+
+def _score_table(cols, cv_scores, penalty, alphas):
+    # summarize test fold r-squared scores by their median, and penalize them for words without vectors
     scores = []
-    for col in cols:
-        # set dependent variable and calculate 10-fold mean fit/predict scores
-        df_subset = df.loc[:, vecs_df.columns.values]  # use .loc[] so copy is created and no setting with copy warning is issued
-        df_subset[col] = df[col]
-        df_subset = df_subset.dropna()  # drop NaNs for this specific y
-        x = df_subset[vecs_df.columns.values]
-        y = df_subset[col]
-        cv_scores = sklearn.model_selection.cross_val_score(model, x, y, cv=cv)
-        median_score = np.median(cv_scores)
+    for i, col in enumerate(cols):
+        median_score = np.median(cv_scores[:, i])
         penalized_score = median_score * penalty
         scores.append({
             'norm': col,
@@ -89,42 +210,96 @@ def predict_norms(vectors, norms, alpha=1.0):
             'adjusted r-squared': penalized_score,
             'r-squared': median_score,
             'r': np.sqrt(median_score),
+            'alpha': alphas[i],
         })
+    return pd.DataFrame(scores)
+
+
+def _curve_table(cols, curve):
+    # list the leave-one-out r-squared for every norm and candidate alpha
+    return pd.DataFrame({
+        'norm': np.repeat(cols, len(alpha_grid)),
+        'alpha': np.tile(alpha_grid, len(cols)),
+        'loo r-squared': curve.ravel(),
+    })
+
+
+@log_timer
+def predict_norms(vectors, norms, alpha=1.0, jobs=1, seed=0):
+    """Predict lexical norms and return score.
+
+    Norms are cross-validated with ridge regression models, using 5-fold cross-validation repeated 10 times.
+    Norms that are observed for the same words share their folds, and each training fold is decomposed only once for all of them.
+    With `alpha='auto'`, alpha is chosen from `alpha_grid` for each norm by efficient leave-one-out cross-validation,
+    which takes a single decomposition of all observed words for every candidate alpha together.
+    Because the same words are used to choose alpha, the 5-fold scores are slightly optimistic in this mode.
+
+    :param vectors: Vectors object containing word vectors
+    :param norms: pandas DataFrame of lexical norms
+    :param alpha: regularization strength, default 1.0, set higher for small datasets, or 'auto' to choose it for each norm
+    :param jobs: number of worker processes to cross-validate groups of norms with the same missing values in (default is 1)
+    :param seed: random seed for shuffling and splitting the norms (default is 0)
+    :return: dict containing scores, predictions, a dict of the fitted model for each norm,
+    and the leave-one-out r-squared for each norm and candidate alpha (None unless alpha is 'auto')
+    """
+    predictions, x, y, penalty = _gather_features(vectors, norms, seed)
+    cols = predictions.columns.values
+    cv_scores, alphas, curve = _cross_validate([(x, y)], alpha, jobs, seed)[0]
+    scores = _score_table(cols, cv_scores, penalty, alphas)
 
     # predict (extend norms)
-    x_full = df[vecs_df.columns.values]
-    predictions = df.loc[:, cols]  # use .loc[] so copy is created and no setting with copy warning is raised by pandas
-    for col in cols:
-        # set dependent variable and fit, but predict for whole x (so including unobserved y)
-        df_subset = df.loc[:, vecs_df.columns.values]  # use .loc[] so copy is created and no setting with copy warning is raised
-        df_subset[col] = df[col]
-        df_subset = df_subset.dropna()  # drop NaNs for this specific y
-        x = df_subset[vecs_df.columns.values]
-        y = df_subset[col]
-        model.fit(x, y)
-        predictions[f'{col} predicted'] = model.predict(x_full)
-
-    return {'scores': pd.DataFrame(scores), 'predictions': predictions}
-
-
-def extend_norms(vecs_fname, norms_fname, alpha=1.0):
+    models = {}
+    for i, col in enumerate(cols):
+        # fit on observed y, but predict for whole x (so including unobserved y)
+        observed = ~np.isnan(y[:, i])
+        models[col] = sklearn.linear_model.Ridge(alpha=alphas[i]).fit(*_observed(x, y[:, i], observed))  # use ridge regression models
+        predictions[f'{col} predicted'] = models[col].predict(x)
+
+    curve = None if curve is None else _curve_table(cols, curve)
+    return {'scores': scores, 'predictions': predictions, 'models': models, 'alphas': curve}
+
+
+def extend_norms(vecs_fname, norms_fname, alpha=1.0, chunksize=100000, jobs=1):
     """Extend lexical norms to unobserved words, using word vectors.
 
-    Writes predictions to tab-separated text file.
+    The norms file is read in chunks, twice: first to collect the words with at least one observed norm, which the models are fitted to,
+    then to predict norms for all words, appending each chunk of predictions to the output file.
+    Memory use therefore depends on the number of observed words, not on the total number of words in the norms file.
+    Writes scores and predictions to tab-separated text files.
 
     :param vecs_fname: file containing word vectors to use for prediction.
     :param norms_fname: file containing norms in tab-separated columns, first column should contain words,
     first line should contain column names, unobserved cells should be left empty
-    :param alpha: regularization strength, default 1.0, set higher for small datasets
+    :param alpha: regularization strength, default 1.0, set higher for small datasets, or 'auto' to choose it for each norm
+    (the leave-one-out scores for every candidate alpha are written to a separate file)
+    :param chunksize: number of words to read and predict norms for at once (default is 100000)
+    :param jobs: number of worker processes to cross-validate with (default is 1)
     """
     logging.info(f'extending lexical norms with {vecs_fname}')
-    vectors = Vectors(vecs_fname, normalize=True, n=1e6, d=300)
-    norms = pd.read_csv(norms_fname, sep='\t', comment='#')
-    norms = norms.set_index('word')
-    results = predict_norms(vectors, norms, alpha)
+    vectors = Vectors(vecs_fname, normalize=True, n=1e6)
     base_fname = '.'.join(norms_fname.split('.')[:-1])
+
+    # fit models to observed norms
+    chunks = pd.read_csv(norms_fname, sep='\t', comment='#', chunksize=int(chunksize))
+    norms = pd.concat([chunk.set_index('word').dropna(how='all') for chunk in chunks])
+    results = predict_norms(vectors, norms, alpha, jobs)
     results['scores'].to_csv(f'{base_fname}.scores.tsv', sep='\t', index=False)
-    results['predictions'].to_csv(f'{base_fname}.predictions.tsv', sep='\t', index=True)
+    if results['alphas'] is not None:
+        results['alphas'].to_csv(f'{base_fname}.alphas.tsv', sep='\t', index=False)
+
+    # predict norms for all words
+    t0 = time.time()
+    words = 0
+    chunks = pd.read_csv(norms_fname, sep='\t', comment='#', chunksize=int(chunksize))
+    for i, chunk in enumerate(chunks):
+        idx, missing = vectors.indices(chunk['word'])
+        predictions = chunk.loc[~missing].set_index('word')
+        x = vectors.rows(idx[~missing])
+        for col, model in results['models'].items():
+            predictions[f'{col} predicted'] = model.predict(x) if len(x) > 0 else []
+        predictions.to_csv(f'{base_fname}.predictions.tsv', sep='\t', index=True, mode='w' if i == 0 else 'a', header=(i == 0))
+        words += len(chunk)
+        logging.info(f'predicted norms for {words} words ({words / (time.time() - t0):.0f} words per second)')
 
 
 if __name__ == '__main__':
@@ -132,10 +307,14 @@ if __name__ == '__main__':
     argparser.add_argument('lang', help='language to predict norms for (uses two-letter ISO language codes)')
     argparser.add_argument('vecs_fname', help='vectors to evaluate (or use for lexical norm extension')
     argparser.add_argument('--extend_norms', help='file containing lexical norms to extend')
-    argparser.add_argument('--alpha', type=float, default=1.0, help='regularization strength, default 1.0, set higher for small datasets')
+    argparser.add_argument('--alpha', default='1.0',
+                           help='regularization strength, default 1.0, set higher for small datasets, or auto to choose it for each norm')
+    argparser.add_argument('--chunksize', default=100000, type=int, help='number of words to read and extend norms for at once')
+    argparser.add_argument('--jobs', default=1, type=int, help='number of worker processes to cross-validate with')
     args = argparser.parse_args()
+    alpha = args.alpha if args.alpha == 'auto' else float(args.alpha)
 
     if args.extend_norms:
-        extend_norms(vecs_fname=args.vecs_fname, norms_fname=args.extend_norms, alpha=args.alpha)
+        extend_norms(vecs_fname=args.vecs_fname, norms_fname=args.extend_norms, alpha=alpha, chunksize=args.chunksize, jobs=args.jobs)
     else:
-        print(evaluate_norms(lang=args.lang, vecs_fname=args.vecs_fname, alpha=args.alpha))
+        print(evaluate_norms(lang=args.lang, vecs_fname=args.vecs_fname, alpha=alpha, jobs=args.jobs))
@@ -0,0 +1,119 @@
+"""Reduce the dimensionality of word vectors using principal component analysis, in bounded memory."""
+import numpy as np
+import argparse
+import os
+from .utensils import log_timer
+from .vecs import Vectors, _vocab_fname
+from .lookup import _file_stamp
+import logging
+logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
+
+
+def _n_suffix(n):
+    # stores reduced from a specific number of word vectors get that number in their filenames
+    return '' if n is None else f'.n{int(n)}'
+
+
+def pca_fname(vecs_fname, n=None):
+    """Gets the filename of the principal components belonging to a set of word vectors.
+
+    :param vecs_fname: file containing word vectors
+    :param n: number of word vectors the components were fitted on, to include in the filename (default is None, which leaves it out)
+    :return: filename of the .npz file the mean, components, and explained variance are stored in, next to the word vectors
+    """
+    return '.'.join(vecs_fname.split('.')[:-1]) + f'{_n_suffix(n)}.pca.npz'
+
+
+def reduced_fname(vecs_fname, d, n=None):
+    """Gets the filename of the reduced-dimension binary store belonging to a set of word vectors.
+
+    :param vecs_fname: file containing word vectors
+    :param d: number of dimensions of the reduced vectors
+    :param n: number of word vectors that were reduced, to include in the filename (default is None, which leaves it out)
+    :return: filename of the .npy file of the binary store, next to the word vectors
+    """
+    return '.'.join(vecs_fname.split('.')[:-1]) + f'{_n_suffix(n)}.pca{d}.npy'
+
+
+def _pca_is_current(vecs_fname, n=None):
+    # whether the principal components were fitted on the current version of the vectors file (identified by its size and modification time)
+    fname = pca_fname(vecs_fname, n)
+    if not os.path.exists(fname):
+        return False
+    with np.load(fname) as pca:
+        return ('stamp' in pca.files) and (str(pca['stamp']) == _file_stamp(vecs_fname))
+
+
+@log_timer
+def fit_pca(vectors, block_rows=65536):
+    """Fits principal components to word vectors in a single streaming pass.
+
+    The mean and scatter matrix are accumulated over blocks of rows, so memory use is independent of the number of word vectors.
+    The components are the eigenvectors of the resulting d by d covariance matrix.
+
+    :param vectors: Vectors object containing word vectors
+    :param block_rows: number of rows to process at once (default is 65536)
+    :return: tuple of numpy arrays containing the mean, the components in rows, and the variance explained by each component, sorted by explained variance
+    """
+    total = np.zeros(vectors.d, dtype=np.float64)
+    scatter = np.zeros((vectors.d, vectors.d), dtype=np.float64)
+    for start in range(0, vectors.n, block_rows):
+        block = vectors.rows(slice(start, start + block_rows)).astype(np.float64)
+        total += block.sum(axis=0)
+        scatter += np.matmul(block.T, block)
+    mean = total / vectors.n
+    covariance = (scatter - vectors.n * np.outer(mean, mean)) / (vectors.n - 1)
+    variance, components = np.linalg.eigh(covariance)
+    order = np.argsort(-variance)
+    return mean, components[:, order].T, variance[order]
+
+
+@log_timer
+def reduce_vecs(vecs_fname, dims=(50, 100, 150), n=1e6, block_rows=65536, name_n=False):
+    """Writes reduced-dimension binary stores of a set of word vectors, by projecting them onto their principal components.
+
+    Vectors are normalized to unit length before fitting the principal components.
+    The projections are written in blocks of rows straight to memory-mapped .npy files, one binary store per number of dimensions (see `reduced_fname()`).
+    The mean, components, and explained variance are saved as well (see `pca_fname()`), so other vectors can be projected onto the same components,
+    along with the number of word vectors they were fitted on and the size and modification time of the vectors file.
+    Open the reduced stores with `Vectors()`, normalizing them again.
+
+    :param vecs_fname: file containing word vectors
+    :param dims: numbers of dimensions to reduce the vectors to (default is 50, 100, and 150)
+    :param n: number of word vectors to reduce (default is 1e6)
+    :param block_rows: number of rows to process at once (default is 65536)
+    :param name_n: include `n` in the filenames, so these stores are kept apart from stores reduced from a different number of vectors (default is False)
+    :return: list of filenames of the reduced binary stores
+    """
+    vectors = Vectors(vecs_fname, normalize=True, n=n)
+    mean, components, variance = fit_pca(vectors, block_rows)
+    fname_n = n if name_n else None
+    np.savez(pca_fname(vecs_fname, fname_n), mean=mean, components=components, explained_variance=variance, n=vectors.n,
+             stamp=_file_stamp(vecs_fname))
+
+    fnames = []
+    for d in dims:
+        fname = reduced_fname(vecs_fname, d, fname_n)
+        logging.info(f'projecting onto {d} components, explaining {variance[:d].sum() / variance.sum():.1%} of variance')
+        projection = components[:d].T.astype(vectors.compute_dtype)
+        shift = np.matmul(mean, components[:d].T).astype(vectors.compute_dtype)
+        reduced = np.lib.format.open_memmap(fname, mode='w+', dtype=vectors.compute_dtype, shape=(vectors.n, d))
+        for start in range(0, vectors.n, block_rows):
+            reduced[start:start + block_rows] = np.matmul(vectors.rows(slice(start, start + block_rows)), projection) - shift
+        reduced.flush()
+        del reduced
+        with open(_vocab_fname(fname), 'w', encoding='utf-8') as vocabfile:
+            vocabfile.write(f'{vectors.n} {d} 0\n')
+            vocabfile.write('\n'.join(vectors.words) + '\n')
+        fnames.append(fname)
+    return fnames
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='write reduced-dimension binary stores of word vectors using principal component analysis')
+    argparser.add_argument('vecs_fname', help='word vectors to reduce')
+    argparser.add_argument('--dims', nargs='+', default=[50, 100, 150], type=int, help='numbers of dimensions to reduce the vectors to')
+    argparser.add_argument('--n', default=1e6, type=float, help='number of word vectors to reduce')
+    args = argparser.parse_args()
+
+    reduce_vecs(**vars(args))
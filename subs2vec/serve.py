@@ -0,0 +1,290 @@
+"""Serve nearest neighbor, similarity, and analogy queries from word vectors kept in memory.
+
+Requests are sent to a local HTTP server (on localhost or a Unix socket) as JSON, for instance:
+`curl -d '{"words": ["cat", "dog"], "num_neighbors": 5}' localhost:8000/neighbors`
+
+Endpoints:
+  - POST /neighbors with `words` (and optionally `num_neighbors`, default 10) returns `neighbors`, a list of [word, similarity] pairs per word
+  - POST /similarities with `pairs` of words returns `similarities`, the cosine similarity for each pair
+  - POST /analogies with `analogies` of words a1, a2, b1 returns `predictions`, the predicted b2 for each analogy
+  - GET /stats returns request, batch, latency, and throughput counters for each endpoint
+
+When more than one set of vectors is served, requests should include `vectors` to select a set by name.
+Missing words result in `null` values. Concurrent requests are coalesced into batches, so similarities are computed in one matrix multiplication per batch.
+"""
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import json
+import time
+import queue
+import threading
+import collections
+import socketserver
+import http.server
+from .vecs import Vectors
+from .neighbors import top_neighbors
+from .analogies import solve_analogies
+import logging
+logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
+max_neighbors = 1000  # largest num_neighbors a client can request
+
+
+class _Stats:
+    # thread-safe request, batch, and latency counters for one endpoint
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.items = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def add_request(self, items, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.items += items
+            self.errors += int(error)
+            self.latencies.append(latency)
+
+    def add_batch(self):
+        with self.lock:
+            self.batches += 1
+
+    def as_dict(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            seconds = time.time() - self.start
+            return {
+                'requests': self.requests,
+                'items': self.items,
+                'batches': self.batches,
+                'errors': self.errors,
+                'mean requests per batch': self.requests / self.batches if self.batches else None,
+                'requests per second': self.requests / seconds,
+                'items per second': self.items / seconds,
+                'median latency ms': float(np.median(latencies)) if len(latencies) else None,
+                '95th percentile latency ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+                'max latency ms': float(latencies.max()) if len(latencies) else None,
+            }
+
+
+class _Batcher:
+    # collects concurrent requests and processes their items in a single call of a batch function
+    def __init__(self, batch_func, stats, max_batch=256, max_wait=.005):
+        self.batch_func = batch_func
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, items):
+        request = {'items': items, 'done': threading.Event(), 'results': None, 'error': None}
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['results']
+
+    def _run(self):
+        while True:
+            # wait for a request, then keep collecting requests until the batch is full or max_wait has passed
+            batch = [self.requests.get()]
+            size = len(batch[0]['items'])
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request['items'])
+
+            items = [item for request in batch for item in request['items']]
+            try:
+                results = self.batch_func(items)
+                self.stats.add_batch()
+                start = 0
+                for request in batch:
+                    request['results'] = results[start:start + len(request['items'])]
+                    start += len(request['items'])
+            except Exception:
+                # process each request on its own, so an error is only returned to the request that caused it
+                for request in batch:
+                    try:
+                        request['results'] = self.batch_func(request['items'])
+                    except Exception as e:
+                        request['error'] = e
+                    self.stats.add_batch()
+            for request in batch:
+                request['done'].set()
+
+
+class _VectorSet:
+    # a resident set of word vectors, with a batcher for each kind of query
+    def __init__(self, vectors, stats, max_batch, max_wait):
+        self.vectors = vectors
+        self.batchers = {
+            'neighbors': _Batcher(self._neighbors, stats['neighbors'], max_batch, max_wait),
+            'similarities': _Batcher(self._similarities, stats['similarities'], max_batch, max_wait),
+            'analogies': _Batcher(self._analogies, stats['analogies'], max_batch, max_wait),
+        }
+
+    def _neighbors(self, items):
+        # items are (word, num_neighbors) tuples
+        words = [word for word, _ in items]
+        idx, missing = self.vectors.indices(words)
+        results = [None] * len(items)
+        found = np.flatnonzero(~missing)
+        if len(found) > 0:
+            num_neighbors = max(items[i][1] for i in found)
+            neighbors, similarities = top_neighbors(self.vectors, self.vectors.rows(idx[found]), num_neighbors, exclude=idx[found])
+            for j, i in enumerate(found):
+                k = items[i][1]
+                results[i] = [[word, float(sim)] for word, sim in zip(self.vectors.words[neighbors[j, :k]], similarities[j, :k])]
+        return results
+
+    def _similarities(self, items):
+        # items are (word1, word2) tuples
+        idx1, missing1 = self.vectors.indices([word1 for word1, _ in items])
+        idx2, missing2 = self.vectors.indices([word2 for _, word2 in items])
+        found = ~(missing1 | missing2)
+        similarities = np.einsum('ij,ij->i', self.vectors.rows(idx1[found]), self.vectors.rows(idx2[found]))
+        results = [None] * len(items)
+        for i, similarity in zip(np.flatnonzero(found), similarities):
+            results[i] = float(similarity)
+        return results
+
+    def _analogies(self, items):
+        # items are (a1, a2, b1) tuples
+        analogies = pd.DataFrame(items, columns=['a1', 'a2', 'b1'])
+        found = np.ones(len(analogies), dtype=bool)
+        for column in analogies.columns:
+            found &= ~self.vectors.indices(analogies[column])[1]
+        results = [None] * len(items)
+        if found.any():
+            predictions = solve_analogies(self.vectors, analogies.loc[found].reset_index(drop=True), novel=True, whole_matrix=True)['predictions']
+            for i, prediction in zip(np.flatnonzero(found), predictions['b2 predicted']):
+                results[i] = prediction
+        return results
+
+
+def _parse_items(endpoint, query, vectors):
+    # check the shape and types of the items in a query before they are batched with other requests
+    fields = {'neighbors': 'words', 'similarities': 'pairs', 'analogies': 'analogies'}
+    items = query[fields[endpoint]]
+    if not isinstance(items, list):
+        raise ValueError(f'{fields[endpoint]} should be a list')
+    if endpoint == 'neighbors':
+        num_neighbors = query.get('num_neighbors', 10)
+        if isinstance(num_neighbors, bool) or not isinstance(num_neighbors, int) or not 1 <= num_neighbors <= min(max_neighbors, vectors.n - 1):
+            raise ValueError(f'num_neighbors should be an integer from 1 to {min(max_neighbors, vectors.n - 1)}')
+        if not all(isinstance(word, str) for word in items):
+            raise ValueError('words should be strings')
+        return [(word, num_neighbors) for word in items]
+    length = 2 if endpoint == 'similarities' else 3
+    for item in items:
+        if not isinstance(item, list) or len(item) != length or not all(isinstance(word, str) for word in item):
+            raise ValueError(f'each item in {fields[endpoint]} should be a list of {length} words')
+    return [tuple(item) for item in items]
+
+
+def _make_handler(vector_sets, stats):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def _respond(self, code, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/stats':
+                self._respond(200, {endpoint: endpoint_stats.as_dict() for endpoint, endpoint_stats in stats.items()})
+            else:
+                self._respond(404, {'error': f'unknown endpoint {self.path}'})
+
+        def do_POST(self):
+            t0 = time.time()
+            endpoint = self.path.strip('/')
+            if endpoint not in stats:
+                self._respond(404, {'error': f'unknown endpoint {self.path}'})
+                return
+            try:
+                query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                name = query.get('vectors', next(iter(vector_sets)) if len(vector_sets) == 1 else None)
+                if name not in vector_sets:
+                    raise KeyError(f'unknown vectors {name}, choose from {list(vector_sets)}')
+                items = _parse_items(endpoint, query, vector_sets[name].vectors)
+                results = vector_sets[name].batchers[endpoint].submit(items)
+            except Exception as e:
+                stats[endpoint].add_request(0, time.time() - t0, error=True)
+                self._respond(400, {'error': repr(e)})
+                return
+            stats[endpoint].add_request(len(items), time.time() - t0)
+            self._respond(200, {endpoint if endpoint != 'analogies' else 'predictions': results})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(vecs_fnames, host='127.0.0.1', port=8000, socket_fname=None, n=1e6, max_batch=256, max_wait=.005):
+    """Loads word vectors and creates a server for neighbor, similarity, and analogy queries.
+
+    Call `serve_forever()` on the returned server to start serving requests.
+    Each set of vectors is named after its filename, without path and extension.
+
+    :param vecs_fnames: list of files containing word vectors to serve
+    :param host: host to listen on (default is 127.0.0.1, so only local clients can connect)
+    :param port: port to listen on (default is 8000)
+    :param socket_fname: Unix socket to listen on instead of host and port (default is None)
+    :param n: number of word vectors to load from each file (default is 1e6)
+    :param max_batch: maximum number of items to coalesce into a batch (default is 256)
+    :param max_wait: maximum time to wait for more requests before processing a batch, in seconds (default is .005)
+    :return: server object
+    """
+    stats = {endpoint: _Stats() for endpoint in ['neighbors', 'similarities', 'analogies']}
+    vector_sets = {}
+    for vecs_fname in vecs_fnames:
+        name = '.'.join(os.path.split(vecs_fname)[1].split('.')[:-1])
+        vector_sets[name] = _VectorSet(Vectors(vecs_fname, normalize=True, n=n), stats, max_batch, max_wait)
+    handler = _make_handler(vector_sets, stats)
+    if socket_fname is not None:
+        if os.path.exists(socket_fname):
+            os.remove(socket_fname)
+        server = _ThreadingUnixHTTPServer(socket_fname, handler)
+        logging.info(f'serving {list(vector_sets)} on {socket_fname}')
+    else:
+        server = _ThreadingHTTPServer((host, port), handler)
+        logging.info(f'serving {list(vector_sets)} on http://{host}:{server.server_port}')
+    return server
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='serve nearest neighbor, similarity, and analogy queries from word vectors kept in memory')
+    argparser.add_argument('vecs_fnames', nargs='+', help='word vectors to serve')
+    argparser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    argparser.add_argument('--port', default=8000, type=int, help='port to listen on')
+    argparser.add_argument('--socket', dest='socket_fname', help='Unix socket to listen on instead of host and port')
+    argparser.add_argument('--n', default=1e6, type=float, help='number of word vectors to load from each file')
+    argparser.add_argument('--max_batch', default=256, type=int, help='maximum number of items to coalesce into a batch')
+    argparser.add_argument('--max_wait', default=.005, type=float, help='maximum time to wait for more requests before processing a batch, in seconds')
+    args = argparser.parse_args()
+
+    make_server(**vars(args)).serve_forever()
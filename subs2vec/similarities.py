@@ -3,15 +3,26 @@ import numpy as np
 import pandas as pd
 import argparse
 import os
-import scipy.spatial.distance
+import time
 import scipy.stats
-from .vecs import Vectors
+from .vecs import Vectors, dataset_vocab, _scores_fname
 from .utensils import log_timer
 import logging
 logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
 path = os.path.dirname(__file__)
 
 
+def _cosines(vectors, idx1, idx2, block_rows=65536):
+    # row-wise cosine similarities between pairs of word vectors, gathering the vectors for blocks of pairs at once
+    cosines = np.empty(len(idx1), dtype=vectors.compute_dtype)
+    for start in range(0, len(idx1), block_rows):
+        vecs1 = vectors.rows(idx1[start:start + block_rows])
+        vecs2 = vectors.rows(idx2[start:start + block_rows])
+        norms = np.sqrt(np.einsum('ij,ij->i', vecs1, vecs1) * np.einsum('ij,ij->i', vecs2, vecs2))
+        cosines[start:start + block_rows] = np.einsum('ij,ij->i', vecs1, vecs2) / norms
+    return cosines
+
+
 @log_timer
 def compare_similarities(vectors, similarities):
     """Correlate vector similarities to human ratings of semantic similarity.
@@ -22,26 +33,21 @@ def compare_similarities(vectors, similarities):
     :param similarities: pandas DataFrame of similarities, labeled word1, word2, and similarity
     :return: dict containing score and predictions in separate pandas DataFrames
     """
-    vecs_dict = vectors.as_dict()
-    vecs_dsm = []
-    similarities_dsm = []
-    word1 = []
-    word2 = []
-    missing = 0
-
-    for index, pair in similarities.iterrows():
-        if all(word in vecs_dict.keys() for word in (pair['word1'], pair['word2'])):
-            vecs_dsm.append(1.0 - scipy.spatial.distance.cosine(vecs_dict[pair['word1']], vecs_dict[pair['word2']]))
-            similarities_dsm.append(pair['similarity'])
-            word1.append(pair['word1'])
-            word2.append(pair['word2'])
-        else:
-            missing += 1
+    # look up rows for both words in each pair, skipping pairs that contain missing words
+    idx1, missing1 = vectors.indices(similarities['word1'])
+    idx2, missing2 = vectors.indices(similarities['word2'])
+    found = ~(missing1 | missing2)
+    missing = (~found).sum()
+
+    vecs_dsm = _cosines(vectors, idx1[found], idx2[found])
+    similarities_dsm = similarities['similarity'].values[found]
+    word1 = similarities['word1'].values[found]
+    word2 = similarities['word2'].values[found]
 
     total = len(similarities)
     penalty = (total - missing) / total
     score = scipy.stats.spearmanr(similarities_dsm, vecs_dsm)[0]
-    adjusted_score = scipy.stats.spearmanr(similarities_dsm, vecs_dsm)[0] * penalty
+    adjusted_score = score * penalty
     score = pd.DataFrame({'rank r': [score], 'adjusted rank r': [adjusted_score]})
     predictions = pd.DataFrame({'word1': word1, 'word2': word2, 'similarity': similarities_dsm, 'predicted similarity': vecs_dsm})
     return {'scores': score, 'predictions': predictions}
@@ -64,7 +70,7 @@ def evaluate_similarities(lang, vecs_fname):
     if not os.path.exists(results_path):
         os.mkdir(results_path)
     logging.info(f'evaluating semantic similarities with {vecs_fname}')
-    vectors = Vectors(vecs_fname, normalize=True, n=1e6, d=300)
+    vectors = Vectors(vecs_fname, normalize=True, n=1e6, vocab=dataset_vocab(lang, ['similarities']))
     scores = []
     for similarities_fname in os.listdir(similarities_path):
         if similarities_fname.startswith(lang):
@@ -73,27 +79,33 @@ def evaluate_similarities(lang, vecs_fname):
             score = compare_similarities(vectors, similarities)['scores']
             score['source'] = similarities_fname
             scores.append(score)
-    scores_fname = os.path.split(vecs_fname)[1].replace('.vec', '.tsv')
+    scores_fname = _scores_fname(vecs_fname)
     if len(scores) > 0:
         scores = pd.concat(scores)
         scores.to_csv(os.path.join(results_path, scores_fname), sep='\t', index=False)
         return scores
 
 
-def novel_similarities(vecs_fname, words_fname):
+def novel_similarities(vecs_fname, words_fname, chunksize=100000):
     """Predict semantic similarities for novel word pairs, using word vectors.
 
+    Word pairs are read, scored, and appended to the output file in chunks, so memory use does not grow with the number of pairs.
     Writes predictions to tab-separated text file.
 
     :param vecs_fname: file containing word vectors to use for prediction.
-    :param similarities_fname: file containing word pairs in tab-separated columns named 'word1' and 'word2'
+    :param words_fname: file containing word pairs in tab-separated columns named 'word1' and 'word2'
+    :param chunksize: number of word pairs to read and score at once (default is 100000)
     """
     logging.info(f'predicting novel semantic similarities with {vecs_fname}')
-    vectors = Vectors(vecs_fname, normalize=True, n=1e6, d=300)
-    df_words = pd.read_csv(words_fname, sep='\t', comment='#')
-    df_words = compute_similarities(vectors, df_words)
+    vectors = Vectors(vecs_fname, normalize=True, n=1e6)
     base_fname = '.'.join(words_fname.split('.')[:-1])
-    df_words.to_csv(f'{base_fname}.predictions.tsv', sep='\t', index=False)
+    t0 = time.time()
+    pairs = 0
+    for i, df_words in enumerate(pd.read_csv(words_fname, sep='\t', comment='#', chunksize=int(chunksize))):
+        df_words = compute_similarities(vectors, df_words)
+        df_words.to_csv(f'{base_fname}.predictions.tsv', sep='\t', index=False, mode='w' if i == 0 else 'a', header=(i == 0))
+        pairs += len(df_words)
+        logging.info(f'predicted similarities for {pairs} word pairs ({pairs / (time.time() - t0):.0f} pairs per second)')
 
 
 def compute_similarities(vectors, df_words):
@@ -103,10 +115,12 @@ def compute_similarities(vectors, df_words):
     :param df_words: pandas DataFrame containing word pairs in columns labeled 'word1' and 'word2'
     :return: pandas DataFrame containing word pairs and cosine similarities in a column labeled 'similarity'
     """
-    vecs_dict = vectors.as_dict()
-    df_words['similarity'] = df_words.apply(lambda x: 1.0 - scipy.spatial.distance.cosine(vecs_dict.get(x['word1'], np.nan),
-                                                                                                  vecs_dict.get(x['word2'], np.nan)),
-                                                                                                  axis=1)
+    idx1, missing1 = vectors.indices(df_words['word1'])
+    idx2, missing2 = vectors.indices(df_words['word2'])
+    found = ~(missing1 | missing2)
+    similarity = np.full(len(df_words), np.nan, dtype=vectors.compute_dtype)
+    similarity[found] = _cosines(vectors, idx1[found], idx2[found])
+    df_words['similarity'] = similarity
     return df_words
 
 
@@ -115,9 +129,10 @@ if __name__ == '__main__':
     argparser.add_argument('lang', help='language to compare simarities in (uses two-letter ISO language codes)')
     argparser.add_argument('vecs_fname', help='word vectors to evaluate')
     argparser.add_argument('--novel_similarities', help='file containing tab-separated word pairs')
+    argparser.add_argument('--chunksize', default=100000, type=int, help='number of novel word pairs to read and score at once')
     args = argparser.parse_args()
 
     if args.novel_similarities:
-        novel_similarities(vecs_fname=args.vecs_fname, similarities_fname=args.novel_similarities)
+        novel_similarities(vecs_fname=args.vecs_fname, words_fname=args.novel_similarities, chunksize=args.chunksize)
     else:
         print(evaluate_similarities(lang=args.lang, vecs_fname=args.vecs_fname))
@@ -1,44 +1,296 @@
 """Provides Vectors object and methods to load, write, and interact with word vectors."""
 import numpy as np
 import pandas as pd
+import argparse
+import os
+import io
+import csv
+import gzip
+import bz2
+import zipfile
+import queue
+import threading
+import itertools
+import multiprocessing
 from .utensils import log_timer
+from .lookup import load_index
 import logging
 logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
+path = os.path.dirname(__file__)
+compressed_extensions = ('.zip', '.gz', '.bz2')
 
 
 class Vectors:
     """Creates a Vectors object containing numpy arrays of words and word vectors.
+
+    Vectors can be loaded from a fastText .vec file or from a binary store written by `Vectors.write_binary()`.
+    .vec files can also be read directly from .zip (e.g. as downloaded by `subs2vec.download`), .gz, or .bz2 archives.
+    A binary store (recognized by its .npy extension) is memory-mapped, so loading is near-instantaneous,
+    rows are only read from disk when they are used, and multiple processes can share the same pages.
+    Large .vec files can be parsed in parallel by setting `jobs` to the number of processes to use.
+
+    Vectors can be stored as float64, float32 (the default), float16, or int8.
+    In int8 mode each row is scalar-quantized, with a per-row scale stored in `Vectors.scales`.
+    Use `Vectors.rows()` to get (dequantized) rows regardless of storage precision.
+    Use `Vectors.indices()` to look up the rows for a list of words.
+
+    To save memory when only a few words are needed, pass a set of words as `vocab` to load only the rows for those words
+    (plus the first `keep_top` rows, regardless of vocab).
+    `Vectors.vocab_size` then holds the number of rows the selection was made from,
+    and `Vectors.ranks` holds the original row (i.e. frequency rank) of each loaded word.
+    Use `dataset_vocab()` to get all words in the evaluation datasets for a language.
+    With `use_index`, the rows for the words in vocab are read using a byte-offset index (see `subs2vec.lookup.load_index()`),
+    instead of scanning the whole .vec file.
+
+    :param fname: .vec file (optionally in a .zip, .gz, or .bz2 archive) or binary store (.npy file) to load vectors from
+    :param normalize: whether to normalize vectors to unit length (default is False)
+    :param n: maximum number of vectors to load, vectors are loaded in file order (default is 1e6)
+    :param d: maximum number of dimensions to load (default is None, which loads all dimensions specified in the file header)
+    :param jobs: number of processes to use for parsing .vec files (default is 1)
+    :param precision: storage precision, options are `float64`, `float32`, `float16`, and `int8`
+    (default is None, which is float32 for .vec files and the stored precision for binary stores)
+    :param vocab: set of words to load vectors for (default is None, which loads vectors for all words)
+    :param keep_top: number of rows to load regardless of vocab (default is 0)
+    :param use_index: whether to seek to the rows for words in vocab using a byte-offset index (default is False)
     """
     @log_timer
-    def __init__(self, fname, normalize=False, n=1e6, d=300):
+    def __init__(self, fname, normalize=False, n=1e6, d=None, jobs=1, precision=None, vocab=None, keep_top=0, use_index=False):
         self.n = int(n)
         self.d = d
+        self.normalized = False
+        self.scales = None
+        self._index = None
         logging.info(f'loading vectors {fname}')
 
-        with open(fname, 'r', encoding='utf-8') as vecfile:
-            # skip header
-            next(vecfile)
+        # parse at full precision only if full precision is requested, quantize after normalizing
+        dtype = np.float64 if precision == 'float64' else np.float32
+        if fname.endswith('.npy'):
+            self._read_binary(fname)
+            if vocab is not None:
+                self._restrict(vocab, keep_top)
+        elif (vocab is not None) and use_index and not fname.endswith(compressed_extensions):
+            self._read_vec_indexed(fname, dtype, vocab, keep_top)
+        elif vocab is not None:
+            # only rows for words in vocab are parsed, which is fast enough in a single process
+            self._read_vec_restricted(fname, dtype, vocab, keep_top)
+        elif (jobs > 1) and fname.endswith(compressed_extensions):
+            logging.warning(f'cannot split compressed file {fname} into byte ranges, parsing it in a single process')
+            self._read_vec(fname, dtype)
+        elif jobs > 1:
+            self._read_vec_parallel(fname, jobs, dtype)
+        else:
+            self._read_vec(fname, dtype)
 
-            # initialize arrays
-            self.vectors = np.zeros((self.n, self.d))
+        if vocab is None:
+            self.vocab_size = self.n
+            self.ranks = np.arange(self.n)
+        else:
+            logging.info(f'loaded vectors for {self.n} out of {self.vocab_size} words')
+
+        if normalize:
+            self.normalize()
+        if precision is not None:
+            self.set_precision(precision)
+
+    def _read_vec(self, fname, dtype):
+        with _open_text(fname) as vecfile:
+            if fname.endswith(compressed_extensions):
+                # decompress on a separate thread, so decompression is pipelined with parsing
+                vecfile = _threaded_lines(vecfile)
+
+            # read shape from header
+            rows, self.d = _parse_header(next(vecfile), self.d)
+            self.n = min(self.n, rows)
+
+            # allocate arrays of exactly the right size
+            self.vectors = np.empty((self.n, self.d), dtype=dtype)
             self.words = np.empty(self.n, dtype=object)
 
             # fill arrays
-            for i, line in enumerate(vecfile):
+            i = 0
+            for i, line in enumerate(vecfile, start=1):
+                rowentries = line.rstrip('\n').split(' ')
+                self.words[i - 1] = rowentries[0]
+                self.vectors[i - 1] = rowentries[1:self.d + 1]
                 if i >= self.n:
                     break
-                rowentries = line.rstrip('\n').split(' ')
-                self.words[i] = rowentries[0]
-                self.vectors[i] = rowentries[1:self.d + 1]
 
-            # truncate empty part of arrays, if necessary
-            self.vectors = self.vectors[:i]
-            self.words = self.words[:i]
-            self.n = i  # reset n to actual array length
+            # truncate arrays if the file contains fewer rows than its header says
+            if i < self.n:
+                logging.warning(f'header of {fname} specifies {rows} rows, but file contains only {i}')
+                self.vectors = self.vectors[:i].copy()
+                self.words = self.words[:i]
+                self.n = i
+
+    def _read_vec_restricted(self, fname, dtype, vocab, keep_top):
+        vocab = set(vocab)
+        lines = []
+        ranks = []
+        with _open_text(fname) as vecfile:
+            if fname.endswith(compressed_extensions):
+                vecfile = _threaded_lines(vecfile)
+            rows, self.d = _parse_header(next(vecfile), self.d)
+
+            # split off the word on every line, but only keep the line if the word is needed
+            self.vocab_size = 0
+            for i, line in enumerate(itertools.islice(vecfile, min(self.n, rows))):
+                if (i < keep_top) or (line.split(' ', 1)[0] in vocab):
+                    lines.append(line)
+                    ranks.append(i)
+                self.vocab_size = i + 1
+        self._parse_lines(lines, ranks, dtype)
+
+    def _read_vec_indexed(self, fname, dtype, vocab, keep_top):
+        index = load_index(fname)
+        with open(fname, 'r', encoding='utf-8') as vecfile:
+            _, self.d = _parse_header(next(vecfile), self.d)
+            self.vocab_size = min(self.n, len(index))
+            index = index.iloc[:self.vocab_size]
+            selected = index.loc[index.index.isin(list(vocab)) | (index['row'] < keep_top)]
+
+        # seek to each selected line, in file order
+        lines = []
+        with open(fname, 'rb') as vecfile:
+            for offset in selected['offset']:
+                vecfile.seek(offset)
+                lines.append(vecfile.readline().decode('utf-8'))
+        self._parse_lines(lines, selected['row'].values, dtype)
+
+    def _parse_lines(self, lines, ranks, dtype):
+        rows = [line.rstrip('\n').split(' ') for line in lines]
+        self.words = np.array([row[0] for row in rows], dtype=object)
+        self.ranks = np.array(ranks, dtype=np.int64)
+        self.vectors = np.array([row[1:self.d + 1] for row in rows], dtype=dtype).reshape(-1, self.d)
+        self.n = len(self.words)
+
+    def _read_vec_parallel(self, fname, jobs, dtype):
+        # split the file into byte ranges that start and end on line boundaries
+        with open(fname, 'rb') as vecfile:
+            _, self.d = _parse_header(next(vecfile).decode('utf-8'), self.d)
+            ranges = _line_ranges(vecfile, jobs * 4)
+
+        with multiprocessing.Pool(jobs) as pool:
+            # count rows in each range, so every range knows which rows of the array it should fill
+            counts = pool.starmap(_count_lines, [(fname, start, stop) for start, stop in ranges])
+        first_rows = np.cumsum([0] + counts)
+        self.n = int(min(self.n, first_rows[-1]))
 
-            # normalize by L1 norm
-            if normalize:
-                self.vectors = self.vectors / np.linalg.norm(self.vectors, axis=1).reshape(-1, 1)
+        # preallocate shared array and parse ranges straight into it
+        shared = multiprocessing.RawArray(np.dtype(dtype).char, self.n * self.d)
+        tasks = [(fname, start, stop, first_row, self.n, self.d, dtype)
+                 for (start, stop), first_row in zip(ranges, first_rows) if first_row < self.n]
+        with multiprocessing.Pool(jobs, initializer=_init_shared, initargs=(shared,)) as pool:
+            words = pool.starmap(_parse_range, tasks)
+        self.vectors = np.frombuffer(shared, dtype=dtype).reshape(self.n, self.d)
+        self.words = np.array([word for chunk in words for word in chunk], dtype=object)
+
+    def _read_binary(self, fname):
+        # header line of the vocab file contains number of rows, dimensions, and whether rows are normalized
+        with open(_vocab_fname(fname), 'r', encoding='utf-8') as vocabfile:
+            rows, d, normalized = [int(x) for x in next(vocabfile).split()]
+            self.n = min(self.n, rows)
+            self.words = np.array([next(vocabfile).rstrip('\n') for _ in range(self.n)], dtype=object)
+        self.d = d if self.d is None else min(self.d, d)
+        # memory-map the array, slicing a memmap does not copy any data
+        self.vectors = np.load(fname, mmap_mode='r')[:self.n, :self.d]
+        scales_fname = _scales_fname(fname)
+        if os.path.exists(scales_fname):
+            self.scales = np.load(scales_fname, mmap_mode='r')[:self.n]
+        self.normalized = bool(normalized)
+
+    def _restrict(self, vocab, keep_top):
+        # copy only the selected rows out of the memory-mapped arrays
+        self.vocab_size = self.n
+        self.ranks = np.flatnonzero(pd.Index(self.words).isin(list(vocab)) | (np.arange(self.n) < keep_top))
+        self.words = self.words[self.ranks]
+        self.vectors = np.asarray(self.vectors[self.ranks])
+        if self.scales is not None:
+            self.scales = np.asarray(self.scales[self.ranks])
+        self.n = len(self.words)
+
+    @property
+    def compute_dtype(self):
+        """Floating point type used for computations, float64 for float64 vectors and float32 otherwise."""
+        return np.float64 if self.vectors.dtype == np.float64 else np.float32
+
+    def rows(self, idx):
+        """Gets word vectors by row index, as floating point numbers regardless of storage precision.
+
+        :param idx: row index, slice, or array of row indices
+        :return: numpy array containing the (dequantized) word vectors
+        """
+        rows = np.asarray(self.vectors[idx], dtype=self.compute_dtype)
+        if self.scales is not None:
+            rows = rows * self.scales[idx][..., np.newaxis]
+        return rows
+
+    def indices(self, words):
+        """Looks up row indices for a list of words.
+
+        The word-to-row index is built on first use and cached, so repeated lookups do not rebuild it.
+        If a word occurs more than once, the first (i.e. most frequent) row is used.
+
+        :param words: list, numpy array, or pandas Series of words to look up
+        :return: tuple of a numpy array of row indices (-1 for missing words) and a boolean numpy array marking missing words
+        """
+        if self._index is None:
+            index = pd.Index(self.words)
+            if index.is_unique:
+                self._index = (index, None)
+            else:
+                first = ~index.duplicated(keep='first')
+                self._index = (index[first], np.flatnonzero(first))
+        index, rows = self._index
+        idx = index.get_indexer(pd.Index(words, dtype=object))
+        missing = idx == -1
+        if rows is not None:
+            idx[~missing] = rows[idx[~missing]]
+        return idx, missing
+
+    def _row_norms(self, block_rows=65536):
+        return np.concatenate([np.linalg.norm(self.rows(slice(start, start + block_rows)), axis=1)
+                               for start in range(0, self.n, block_rows)])
+
+    def normalize(self):
+        """Normalizes word vectors to unit length.
+
+        Vectors that are already normalized (e.g. when loaded from a binary store of normalized vectors) are left as is,
+        otherwise this creates a normalized in-memory copy of the vectors (or only of the scales, for int8 vectors).
+        """
+        if not self.normalized:
+            # normalize by L2 norm
+            norms = self._row_norms()
+            if self.scales is not None:
+                self.scales = (self.scales / norms).astype(np.float32)
+            else:
+                self.vectors = (self.vectors / norms.reshape(-1, 1)).astype(self.vectors.dtype, copy=False)
+            self.normalized = True
+
+    def set_precision(self, precision, block_rows=65536):
+        """Converts word vectors to a different storage precision.
+
+        In int8 mode, each row is scaled so its largest absolute value maps to 127,
+        and the per-row scales are kept in `Vectors.scales`.
+
+        :param precision: storage precision, options are `float64`, `float32`, `float16`, and `int8`
+        :param block_rows: number of rows to convert at once (default is 65536)
+        """
+        dtype = np.dtype(precision)
+        if (self.vectors.dtype == dtype) and ((self.scales is not None) == (precision == 'int8')):
+            return
+        vectors = np.empty(self.vectors.shape, dtype=dtype)
+        scales = np.empty(self.n, dtype=np.float32) if precision == 'int8' else None
+        for start in range(0, self.n, block_rows):
+            block = self.rows(slice(start, start + block_rows))
+            if scales is not None:
+                block_scales = np.abs(block).max(axis=1) / 127.0
+                block_scales[block_scales == 0] = 1.0
+                vectors[start:start + block_rows] = np.rint(block / block_scales.reshape(-1, 1))
+                scales[start:start + block_rows] = block_scales
+            else:
+                vectors[start:start + block_rows] = block
+        self.vectors = vectors
+        self.scales = scales
 
     @log_timer
     def as_df(self):
@@ -48,7 +300,7 @@ class Vectors:
 
         :return: pandas DataFrame containing word vectors
         """
-        return pd.DataFrame(self.vectors).set_index(self.words)
+        return pd.DataFrame(self.rows(slice(None))).set_index(self.words)
 
     @log_timer
     def as_dict(self):
@@ -58,13 +310,191 @@ class Vectors:
 
         :return: Python dict containing word vectors
         """
-        return {self.words[i]: self.vectors[i] for i in range(self.n)}
+        vectors = self.rows(slice(None))
+        return {self.words[i]: vectors[i] for i in range(self.n)}
 
     @log_timer
-    def write_vecs(self, vecs_fname):
+    def write_vecs(self, vecs_fname, digits=6, chunk_rows=10000):
         """Writes word vectors to .vec file.
 
+        Writes a fastText header, followed by rows that are formatted and written in chunks, so memory use stays bounded.
+        Filenames ending in .gz or .bz2 are compressed while writing.
+
         :param vecs_fname: filename to write vectors to
+        :param digits: number of significant digits to write for each value (default is 6, like fastText)
+        :param chunk_rows: number of rows to format at once (default is 10000)
         """
-        header = f'{self.vectors.shape[0]} {self.vectors.shape[1]}'
-        np.savetxt(vecs_fname, np.hstack([self.words.reshape(-1, 1), self.vectors]), fmt='%s', header=header)
+        row_fmt = '%s' + f' %.{digits}g' * self.vectors.shape[1] + '\n'
+        with _open_text(vecs_fname, 'w') as vecfile:
+            vecfile.write(f'{self.vectors.shape[0]} {self.vectors.shape[1]}\n')
+            for start in range(0, self.n, chunk_rows):
+                words = self.words[start:start + chunk_rows]
+                rows = self.rows(slice(start, start + chunk_rows)).tolist()
+                vecfile.write(''.join([row_fmt % (word, *row) for word, row in zip(words, rows)]))
+
+    @log_timer
+    def write_binary(self, npy_fname):
+        """Writes word vectors to a binary store that can be memory-mapped.
+
+        The store consists of a .npy file containing the vectors as a contiguous array
+        and a .vocab file containing the words, one per line.
+        For int8 vectors, the per-row scales are written to an additional .scales.npy file.
+        Pass the .npy filename to `Vectors()` to open the store.
+
+        :param npy_fname: filename to write the vectors array to (should end in .npy)
+        """
+        np.save(npy_fname, np.ascontiguousarray(self.vectors))
+        if self.scales is not None:
+            np.save(_scales_fname(npy_fname), np.ascontiguousarray(self.scales))
+        with open(_vocab_fname(npy_fname), 'w', encoding='utf-8') as vocabfile:
+            vocabfile.write(f'{self.vectors.shape[0]} {self.vectors.shape[1]} {int(self.normalized)}\n')
+            vocabfile.write('\n'.join(self.words) + '\n')
+
+
+def dataset_vocab(lang, tasks=('analogies', 'similarities', 'norms')):
+    """Gets the set of all words in the evaluation datasets for a given language.
+
+    :param lang: language to get words for (uses two-letter ISO codes)
+    :param tasks: evaluation tasks to include datasets from (default is analogies, similarities, and norms)
+    :return: set of words
+    """
+    word_columns = ['a1', 'a2', 'b1', 'b2', 'word1', 'word2', 'word']
+    vocab = set()
+    for task in tasks:
+        datasets_path = os.path.join(path, 'datasets', task)
+        for fname in os.listdir(datasets_path):
+            if fname.startswith(lang) and fname.endswith('.tsv'):
+                dataset = pd.read_csv(os.path.join(datasets_path, fname), sep='\t', comment='#')
+                for column in dataset.columns.intersection(word_columns):
+                    vocab.update(dataset[column].dropna().astype(str))
+    return vocab
+
+
+def _open_text(fname, mode='r'):
+    # open plain text, or text compressed with gzip, bzip2, or zip (read only), based on file extension
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode + 't', encoding='utf-8', compresslevel=6)
+    elif fname.endswith('.bz2'):
+        return bz2.open(fname, mode + 't', encoding='utf-8')
+    elif fname.endswith('.zip'):
+        # read the first .vec file in the archive (or the first file, if there is no .vec file)
+        with zipfile.ZipFile(fname) as archive:
+            names = archive.namelist()
+            member = next((name for name in names if name.endswith('.vec')), names[0])
+            # the underlying file stays open until the member is closed
+            return io.TextIOWrapper(archive.open(member), encoding='utf-8')
+    else:
+        return open(fname, mode, encoding='utf-8')
+
+
+def _threaded_lines(textfile, batch_size=2 ** 22, max_batches=16):
+    # iterate over lines of a file, while a separate thread reads (and decompresses) batches of lines ahead
+    batches = queue.Queue(max_batches)
+    stop = threading.Event()
+    errors = []
+
+    def read_batches():
+        try:
+            for batch in iter(lambda: textfile.readlines(batch_size), []):
+                if stop.is_set():
+                    return
+                batches.put(batch)
+        except Exception as error:
+            errors.append(error)
+        batches.put(None)
+
+    reader = threading.Thread(target=read_batches, daemon=True)
+    reader.start()
+    try:
+        for batch in iter(batches.get, None):
+            yield from batch
+        if errors:
+            raise errors[0]
+    finally:
+        # if iteration stopped early, make sure the reader is not left waiting for queue space
+        stop.set()
+        while reader.is_alive():
+            try:
+                batches.get(timeout=.1)
+            except queue.Empty:
+                pass
+
+
+def _scores_fname(vecs_fname):
+    # name of the results file for a set of word vectors: the filename without directory and word vector extensions, plus .tsv
+    base_fname = os.path.split(vecs_fname)[1]
+    while os.path.splitext(base_fname)[1] in ('.vec', '.npy', '.zip', '.gz', '.bz2'):
+        base_fname = os.path.splitext(base_fname)[0]
+    return base_fname + '.tsv'
+
+
+def _vocab_fname(npy_fname):
+    return npy_fname[:-len('.npy')] + '.vocab'
+
+
+def _scales_fname(npy_fname):
+    return npy_fname[:-len('.npy')] + '.scales.npy'
+
+
+def _parse_header(header, d=None):
+    # fastText header contains number of rows and dimensions (np.savetxt prepends a "# ")
+    rows, header_d = [int(x) for x in header.lstrip('# ').split()[:2]]
+    if d is None:
+        return rows, header_d
+    return rows, min(d, header_d)
+
+
+def _line_ranges(binfile, n_ranges):
+    # find byte ranges of roughly equal size, moving each boundary forward to the start of the next line
+    start = binfile.tell()
+    size = os.fstat(binfile.fileno()).st_size
+    bounds = [start]
+    for i in range(1, n_ranges):
+        binfile.seek(max(start + (size - start) * i // n_ranges, bounds[-1]))
+        binfile.readline()
+        bounds.append(binfile.tell())
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def _read_range(fname, start, stop):
+    with open(fname, 'rb') as binfile:
+        binfile.seek(start)
+        return binfile.read(stop - start)
+
+
+def _count_lines(fname, start, stop):
+    chunk = _read_range(fname, start, stop)
+    return chunk.count(b'\n') + int(not chunk.endswith(b'\n'))
+
+
+_shared = {}
+
+
+def _init_shared(shared):
+    _shared['vectors'] = shared
+
+
+def _parse_range(fname, start, stop, first_row, n, d, dtype):
+    # pandas' C parser converts floats considerably faster than str.split or np.fromstring
+    rows = pd.read_csv(io.BytesIO(_read_range(fname, start, stop)), sep=' ', header=None, usecols=range(d + 1),
+                       nrows=n - first_row, dtype={0: str}, quoting=csv.QUOTE_NONE, na_filter=False, encoding='utf-8')
+    vectors = np.frombuffer(_shared['vectors'], dtype=dtype).reshape(n, d)
+    vectors[first_row:first_row + len(rows)] = rows.iloc[:, 1:].to_numpy(dtype=dtype)
+    return list(rows[0])
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='convert a .vec file to a memory-mappable binary store')
+    argparser.add_argument('vecs_fname', help='.vec file to convert')
+    argparser.add_argument('--n', default=1e6, type=float, help='maximum number of vectors to convert')
+    argparser.add_argument('--d', type=int, help='maximum number of dimensions to convert (default is all dimensions)')
+    argparser.add_argument('--normalize', action='store_true', help='normalize vectors to unit length before writing')
+    argparser.add_argument('--jobs', default=1, type=int, help='number of processes to use for parsing the .vec file')
+    argparser.add_argument('--precision', default='float32', choices=['float64', 'float32', 'float16', 'int8'],
+                           help='storage precision of the binary store')
+    args = argparser.parse_args()
+
+    vectors = Vectors(args.vecs_fname, normalize=args.normalize, n=args.n, d=args.d, jobs=args.jobs, precision=args.precision)
+    base_fname = '.'.join(args.vecs_fname.split('.')[:-1])
+    vectors.write_binary(f'{base_fname}.npy')